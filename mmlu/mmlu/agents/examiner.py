@@ -1,5 +1,6 @@
-from typing import List, Optional
+from typing import List, Optional, Union
 
+from datasets import Dataset
 from leaf_playground.core.scene_agent import SceneStaticAgentConfig, SceneStaticAgent
 from leaf_playground.data.profile import Profile
 from leaf_playground.data.media import Text
@@ -24,7 +25,10 @@ class Examiner(
         super().__init__(config=config)
 
         self._cur = 0
-        self._questions = []
+        # a list of samples, or a memory-mapped Dataset in streaming mode, both are indexed by sample id
+        self._questions: Union[List[dict], Dataset] = []
+        # the answer column alone, so that looking up a golden answer doesn't decode the whole row
+        self._answers: Union[List[dict], Dataset] = []
         self._ds_config: DatasetConfig = None
 
     async def prepare_samples(
@@ -33,15 +37,21 @@ class Examiner(
     ) -> None:
         self._cur = 0
         self._questions = prepare_samples(ds_config)
+        if isinstance(self._questions, Dataset):
+            self._answers = self._questions.select_columns([ANSWER_COL])
+        else:
+            self._answers = self._questions
         self._ds_config = ds_config
 
     async def send_sample(self, receivers: List[Profile]) -> ExaminerSample:
+        row = self._questions[self._cur]
+        question = row[QUESTION_COL]
         sample = ExaminerSample(
             sender=self.profile,
             receivers=receivers,
-            content=Text(text=self._questions[self._cur][QUESTION_COL],
-                         display_text=self._questions[self._cur][QUESTION_COL]),
-            sample_id=self._cur
+            content=Text(text=question, display_text=question),
+            sample_id=self._cur,
+            subject=row.get(SUBJECT_COL)
         )
         self._cur += 1
         return sample
@@ -50,7 +60,7 @@ class Examiner(
         return self._cur >= len(self._questions)
 
     def get_golden_answer(self, sample_id: int) -> Optional[str]:
-        return self._questions[sample_id][ANSWER_COL]
+        return self._answers[sample_id][ANSWER_COL]
 
 
 __all__ = [
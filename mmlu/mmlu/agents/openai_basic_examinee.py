@@ -1,4 +1,7 @@
-from typing import Literal, Type, Union
+import asyncio
+import json
+import re
+from typing import Dict, List, Literal, Optional, Tuple, Type, Union
 
 from leaf_ai_backends.openai import OpenAIBackend, OpenAIBackendConfig, OpenAIClientConfig, AzureOpenAIClientConfig
 from leaf_playground.data.media import Text
@@ -14,6 +17,8 @@ from .base_examinee import (
     AIBaseExaminee,
     AIBaseExamineeConfig
 )
+from ..rate_limiter import RateLimitConfig
+from ..response_cache import ResponseCacheConfig, create_chat_completion
 from ..scene_definition import ExamineeAnswer, ExaminerSample
 
 
@@ -37,6 +42,19 @@ class CustomOpenAIBackendConfig(OpenAIBackendConfig):
 class OpenAIBasicExamineeConfig(AIBaseExamineeConfig):
     ai_backend_config: CustomOpenAIBackendConfig = Field(default=...)
     ai_backend_cls: Type[OpenAIBackend] = Field(default=OpenAIBackend, exclude=True)
+    response_cache_config: ResponseCacheConfig = Field(default_factory=ResponseCacheConfig)
+    rate_limit_config: RateLimitConfig = Field(default_factory=RateLimitConfig)
+    batch_size: int = Field(
+        default=1,
+        ge=1,
+        description="how many samples can be packed into one request, 1 means each sample is sent on its own, "
+                    "only samples answered at the same time are packed, see the scene's scheduler_config"
+    )
+    batch_wait_seconds: float = Field(
+        default=0.05,
+        ge=0,
+        description="how long a sample waits for others to fill its batch before the batch is sent"
+    )
 
 
 class OpenAIBasicExaminee(AIBaseExaminee, cls_description="Examinee agent using OpenAI API to answer questions"):
@@ -46,31 +64,132 @@ class OpenAIBasicExaminee(AIBaseExaminee, cls_description="Examinee agent using
     def __init__(self, config: config_cls):
         super().__init__(config=config)
 
-    async def answer(self, sample: ExaminerSample, examiner: Profile) -> ExamineeAnswer:
+        # samples waiting to be packed into the next batch, with the futures their answers are set on
+        self._pending: List[Tuple[ExaminerSample, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+
+    def _system_msg(self, batched: bool) -> str:
+        if batched:
+            task = (
+                f"You will receive a list of questions, each with a list of choices, from the examiner(user), "
+                f"the task you need to do is to choose the correct answer of each question from its choices. "
+                f"Please only answer with a JSON object that maps each question's id to the index of its "
+                f"correct answer, like {{\"0\": \"A\", \"1\": \"C\"}}, do not explain your choices."
+            )
+        else:
+            task = (
+                f"You will receive a question and a list of choices from the examiner(user), the task you "
+                f"need to do is to choose the correct answer from the given choices. Please only answer with "
+                f"the index of the correct answer, do not explain your choice."
+            )
+        return f"Your name is {self.name}, an {self.profile.role.name}, {self.profile.role.description}. {task}"
+
+    async def _answer_one(self, sample: ExaminerSample) -> str:
+        client: AsyncOpenAI = self.backend.async_client
+        model = self.config.ai_backend_config.chat_model
+
+        # a failed call raises, the scene records the sample as failed instead of scoring an empty answer
+        content = await create_chat_completion(
+            client,
+            self.config.response_cache_config,
+            rate_limit_config=self.config.rate_limit_config,
+            messages=[
+                ChatCompletionSystemMessageParam(role="system", content=self._system_msg(batched=False)),
+                ChatCompletionUserMessageParam(role="user", content=sample.content.text),
+            ],
+            model=model,
+            max_tokens=2
+        )
+        return content or ""
+
+    async def _answer_many(self, samples: List[ExaminerSample]) -> Dict[int, str]:
         client: AsyncOpenAI = self.backend.async_client
         model = self.config.ai_backend_config.chat_model
 
-        system_msg = (
-            f"Your name is {self.name}, an {self.profile.role.name}, {self.profile.role.description}. "
-            f"You will receive a question and a list of choices from the examiner(user), the task you "
-            f"need to do is to choose the correct answer from the given choices. Please only answer with "
-            f"the index of the correct answer, do not explain your choice."
+        examiner_msg = "\n\n".join(
+            f"### Question {sample.sample_id}\n{sample.content.text}" for sample in samples
         )
-        examiner_msg = sample.content.text
         try:
-            resp = await client.chat.completions.create(
+            content = await create_chat_completion(
+                client,
+                self.config.response_cache_config,
+                rate_limit_config=self.config.rate_limit_config,
                 messages=[
-                    ChatCompletionSystemMessageParam(role="system", content=system_msg),
+                    ChatCompletionSystemMessageParam(role="system", content=self._system_msg(batched=True)),
                     ChatCompletionUserMessageParam(role="user", content=examiner_msg),
                 ],
                 model=model,
-                max_tokens=2
+                max_tokens=16 + 10 * len(samples)
             )
-        except:
-            resp = None
+            match = re.search(r"\{.*\}", content or "", re.DOTALL)
+            answers = json.loads(match.group()) if match else {}
+        except Exception:
+            return {}
+        if not isinstance(answers, dict):
+            return {}
+        sample_ids = {sample.sample_id for sample in samples}
+        results = {}
+        for sample_id, answer in answers.items():
+            try:
+                sample_id = int(sample_id)
+            except ValueError:
+                continue
+            if sample_id in sample_ids and isinstance(answer, str) and answer.strip():
+                results[sample_id] = answer.strip()
+        return results
+
+    async def _answer_pending(self, pending: List[Tuple[ExaminerSample, asyncio.Future]]) -> None:
+        try:
+            answers = await self._answer_many([sample for sample, _ in pending]) if len(pending) > 1 else {}
+            # samples the batched answer failed to cover are asked again one by one
+            missing = [sample for sample, _ in pending if sample.sample_id not in answers]
+            retried = await asyncio.gather(*[self._answer_one(s) for s in missing], return_exceptions=True)
+            for sample, answer in zip(missing, retried):
+                answers[sample.sample_id] = answer
+            for sample, future in pending:
+                if future.done():
+                    continue
+                answer = answers[sample.sample_id]
+                if isinstance(answer, Exception):
+                    future.set_exception(answer)
+                else:
+                    future.set_result(answer)
+        except asyncio.CancelledError:
+            for _, future in pending:
+                future.cancel()
+            raise
+        except Exception as e:
+            # nothing awaits this task, the samples' answer calls get the error
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+
+    def _flush_pending(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        pending, self._pending = self._pending, []
+        if pending:
+            asyncio.ensure_future(self._answer_pending(pending))
+
+    async def _answer_batched(self, sample: ExaminerSample) -> str:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((sample, future))
+        if len(self._pending) >= self.config.batch_size:
+            self._flush_pending()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.config.batch_wait_seconds, self._flush_pending)
+        return await future
+
+    async def answer(self, sample: ExaminerSample, examiner: Profile) -> ExamineeAnswer:
+        if self.config.batch_size > 1:
+            answer = await self._answer_batched(sample)
+        else:
+            answer = await self._answer_one(sample)
         return ExamineeAnswer(
             sample_id=sample.sample_id,
-            content=Text(text=resp.choices[0].message.content if resp else ""),
+            content=Text(text=answer),
             sender=self.profile,
             receivers=[examiner]
         )
@@ -0,0 +1,131 @@
+import math
+from abc import abstractmethod, ABC
+from typing import Any, Callable, Optional, Tuple
+
+import numpy as np
+
+
+class RunningStats:
+    """Count, sum and sum of squares of a stream of numbers, values can be added and removed in O(1)."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        self.total_sq += value * value
+
+    def remove(self, value: float) -> None:
+        self.count -= 1
+        self.total -= value
+        self.total_sq -= value * value
+
+    @property
+    def mean(self) -> Optional[float]:
+        return self.total / self.count if self.count else None
+
+    @property
+    def variance(self) -> Optional[float]:
+        if self.count < 2:
+            return None
+        # sample variance, clipped at 0 since float error can make it slightly negative
+        return max(0.0, (self.total_sq - self.total * self.total / self.count) / (self.count - 1))
+
+    def confidence_interval(self, z: float = 1.96) -> Optional[tuple]:
+        """Normal approximation interval of the mean, z=1.96 gives a 95% interval."""
+        if self.variance is None:
+            return None
+        half_width = z * math.sqrt(self.variance / self.count)
+        return self.mean - half_width, self.mean + half_width
+
+
+class IncrementalAggregator(ABC):
+    """
+    Aggregates records of one metric and one agent as they come, instead of over the whole record list each time
+    the reporter aggregates. `add` and `remove` take a record's value, `remove` is used when a human record
+    overrides an evaluator's one.
+    """
+
+    @abstractmethod
+    def add(self, value: Any) -> None:
+        pass
+
+    @abstractmethod
+    def remove(self, value: Any) -> None:
+        pass
+
+    @property
+    @abstractmethod
+    def value(self) -> Any:
+        pass
+
+    @abstractmethod
+    def get_summary(self) -> dict:
+        pass
+
+
+class MeanAggregator(IncrementalAggregator):
+    def __init__(self, ndigits: int = 4):
+        self.ndigits = ndigits
+        self.stats = RunningStats()
+
+    def add(self, value: Any) -> None:
+        self.stats.add(float(value))
+
+    def remove(self, value: Any) -> None:
+        self.stats.remove(float(value))
+
+    @property
+    def value(self) -> Optional[float]:
+        mean = self.stats.mean
+        return round(mean, self.ndigits) if mean is not None else None
+
+    def get_summary(self) -> dict:
+        interval = self.stats.confidence_interval()
+        return {
+            "value": self.value,
+            "count": self.stats.count,
+            "ci_low": round(interval[0], self.ndigits) if interval else None,
+            "ci_high": round(interval[1], self.ndigits) if interval else None
+        }
+
+
+def incremental_aggregator(aggregator_factory: Callable[[], IncrementalAggregator]):
+    """
+    Register an incremental aggregator alongside an aggregation function, the function is still what the reporter
+    uses for saved metrics, the aggregator is what live metrics use and must agree with it.
+    """
+    def decorator(fn):
+        fn.incremental_aggregator = aggregator_factory
+        return fn
+
+    return decorator
+
+
+def wilson_interval(successes, totals, z: float = 1.96) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Wilson score intervals of proportions `successes / totals`, element-wise over arrays, z=1.96 gives 95%
+    intervals. Unlike the normal approximation they stay inside [0, 1] and don't collapse at 0% or 100%.
+    """
+    successes = np.asarray(successes, dtype=np.float64)
+    totals = np.asarray(totals, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p = successes / totals
+        denominator = 1 + z * z / totals
+        center = (p + z * z / (2 * totals)) / denominator
+        half_width = z * np.sqrt(p * (1 - p) / totals + z * z / (4 * totals * totals)) / denominator
+    low = np.where(totals > 0, np.clip(center - half_width, 0.0, 1.0), np.nan)
+    high = np.where(totals > 0, np.clip(center + half_width, 0.0, 1.0), np.nan)
+    return low, high
+
+
+__all__ = [
+    "RunningStats",
+    "IncrementalAggregator",
+    "MeanAggregator",
+    "incremental_aggregator",
+    "wilson_interval"
+]
@@ -1,13 +1,71 @@
 from typing import List
 
+import numpy as np
 import pandas as pd
+from leaf_playground.chart_tools.grouped_bar import GroupedBar
 from leaf_playground.chart_tools.simple_bar import SimpleBar
 from leaf_playground.core.scene_definition import CombinedMetricsData, SceneConfig
 from leaf_playground.core.workers import MetricEvaluatorConfig, Chart
 from leaf_playground.data.log_body import LogBody
 
+from ..aggregation import wilson_interval
+
+METRIC_NAME = "examinee.answer.accurate"
+FMT = ".1%"
+
+
+def _add_intervals(layers: List[dict]) -> None:
+    """Draw each bar's 95% Wilson interval over it, on the [bar, text] layers chart_tools bars are made of."""
+    bar, text = layers
+    bar["encoding"]["tooltip"] = [
+        {"field": "value", "type": "quantitative", "format": FMT},
+        {"field": "ci_low", "type": "quantitative", "format": FMT},
+        {"field": "ci_high", "type": "quantitative", "format": FMT},
+        {"field": "count", "type": "quantitative"}
+    ]
+    category = {key: bar["encoding"]["y"][key] for key in ["field", "type"]}
+    layers.insert(1, {
+        "mark": {"type": "rule"},
+        "encoding": {
+            "y": category,
+            "x": {"field": "ci_low", "type": "quantitative"},
+            "x2": {"field": "ci_high"}
+        }
+    })
+    # labels go right of the interval instead of over it
+    text["encoding"]["x"] = {"field": "ci_high", "type": "quantitative"}
+
+
+class _IntervalSimpleBar(SimpleBar):
+    def generate(self, data: pd.DataFrame) -> dict:
+        # use the data format of SimpleBar, plus ci_low, ci_high and count
+        spec = super().generate(data)
+        _add_intervals(spec["layer"])
+        return spec
+
+
+class _IntervalGroupedBar(GroupedBar):
+    def generate(self, data: pd.DataFrame) -> dict:
+        # use the data format of GroupedBar, plus ci_low, ci_high and count
+        spec = super().generate(data)
+        _add_intervals(spec["spec"]["layer"])
+        return spec
+
+
+def _vconcat(*specs: dict) -> dict:
+    """Stack Vega-Lite specs made by altair into one, their datasets are merged."""
+    charts = []
+    datasets = {}
+    for spec in specs:
+        spec = dict(spec)
+        schema = spec.pop("$schema")
+        config = spec.pop("config", {})
+        datasets.update(spec.pop("datasets", {}))
+        charts.append(spec)
+    return {"$schema": schema, "config": config, "datasets": datasets, "vconcat": charts}
+
 
-class AccuracyChart(Chart, chart_name="accuracy", supported_metric_names=["examinee.answer.accurate"]):
+class AccuracyChart(Chart, chart_name="accuracy", supported_metric_names=[METRIC_NAME]):
 
     def _generate(
             self,
@@ -16,44 +74,65 @@ class AccuracyChart(Chart, chart_name="accuracy", supported_metric_names=["exami
             evaluator_configs: List[MetricEvaluatorConfig],
             logs: List[LogBody]
     ) -> dict:
-        chart = SimpleBar(mode="percent")
+        agents, subjects, accurate = self._to_columns(metrics['merged_metrics'])
 
         role_config = scene_config.roles_config.get_role_config('examinee')
         color_mapping = {
             agent_config.config_data.get('profile').get('id'): agent_config.config_data.get('chart_major_color') for
             agent_config in role_config.agents_config
         }
+        chart = _IntervalSimpleBar(mode="percent").generate(self._transform_data(agents, accurate, color_mapping))
 
-        data = self._transform_data(metrics['merged_metrics'], color_mapping)
-
-        return chart.generate(data)
+        if len(pd.unique(subjects)) > 1:
+            # split each examinee's accuracy out by subject when the task ran more than one subject
+            subject_chart = _IntervalGroupedBar(mode="percent").generate(
+                self._transform_subject_data(agents, subjects, accurate)
+            )
+            chart = _vconcat(chart, subject_chart)
+        return chart
 
     @staticmethod
-    def _transform_data(metrics, color_mapping: dict):
-        combined_results = {}
-        for metric, entries in metrics.items():
-            metric_key = metric.split('.')[-1]
-
-            for entry in entries:
-                agent = entry.target_agent
-                value = entry.value
-
-                if agent not in combined_results:
-                    combined_results[agent] = {}
-
-                if metric_key not in combined_results[agent]:
-                    combined_results[agent][metric_key] = 0
-
-                combined_results[agent][metric_key] += value
-
-        flattened_results_pythonic = [
-            {"agent": agent, "color": color_mapping.get(agent), "value": value}
-            for agent, metrics in combined_results.items()
-            for metric, value in metrics.items()
-            if metric == 'accurate'
+    def _to_columns(metrics):
+        """Flatten all records into (agent, subject, accurate) columns, the only Python-level pass over them."""
+        records = [
+            record
+            for metric, entries in metrics.items()
+            if metric == METRIC_NAME
+            for entry in entries
+            for record in entry.records
         ]
+        agents = np.array([record.target_agent for record in records], dtype=object)
+        subjects = np.array([(record.misc or {}).get("subject") or "unknown" for record in records], dtype=object)
+        accurate = np.fromiter((bool(record.value) for record in records), dtype=bool, count=len(records))
+        return agents, subjects, accurate
 
-        return pd.DataFrame(flattened_results_pythonic)
+    @staticmethod
+    def _accuracy_frame(group_ids: np.ndarray, num_groups: int, accurate: np.ndarray) -> pd.DataFrame:
+        totals = np.bincount(group_ids, minlength=num_groups)
+        successes = np.bincount(group_ids, weights=accurate, minlength=num_groups)
+        ci_low, ci_high = wilson_interval(successes, totals)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            value = successes / totals
+        return pd.DataFrame({"value": value, "ci_low": ci_low, "ci_high": ci_high, "count": totals})
+
+    @classmethod
+    def _transform_data(cls, agents: np.ndarray, accurate: np.ndarray, color_mapping: dict):
+        agent_ids, agent_names = pd.factorize(agents)
+        data = cls._accuracy_frame(agent_ids, len(agent_names), accurate)
+        data.insert(0, "agent", agent_names)
+        data.insert(1, "color", [color_mapping.get(agent) for agent in agent_names])
+        return data
+
+    @classmethod
+    def _transform_subject_data(cls, agents: np.ndarray, subjects: np.ndarray, accurate: np.ndarray):
+        agent_ids, agent_names = pd.factorize(agents, sort=True)
+        subject_ids, subject_names = pd.factorize(subjects, sort=True)
+        group_ids = agent_ids * len(subject_names) + subject_ids
+        data = cls._accuracy_frame(group_ids, len(agent_names) * len(subject_names), accurate)
+        data.insert(0, "agent", np.repeat(agent_names, len(subject_names)))
+        data.insert(1, "metric", np.tile(subject_names, len(agent_names)))
+        # drop subjects an agent has no record of
+        return data[data["count"] > 0].reset_index(drop=True)
 
 
 __all__ = ["AccuracyChart"]
@@ -1,10 +1,13 @@
+import hashlib
 import json
 import os
 import random
+import shutil
+from collections import defaultdict
 from enum import Enum
-from typing import Any, Dict, List, Union
+from typing import Any, Dict, List, Optional, Union
 
-from datasets import load_dataset
+from datasets import Dataset, concatenate_datasets, load_dataset, load_from_disk
 from pydantic import Field
 
 from leaf_playground._config import _Config
@@ -24,21 +27,74 @@ DS_NAMES = Enum(
 )
 QUESTION_COL = "question"
 ANSWER_COL = "answer"
+SUBJECT_COL = "subject"
+ALL_SUBJECTS = [n.value for n in DS_NAMES if n.value != "all"]
+DS_CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "dataset", "mmlu_cache")
+# bump this whenever `preprocess` formats samples differently, so that stale cached samples are not reused
+PROMPT_TEMPLATE_VERSION = 2
 
 
 class DatasetConfig(_Config):
     dataset_name: DS_NAMES = Field(json_schema_extra={"default": getattr(DS_NAMES, "abstract_algebra")})
+    dataset_names: Optional[List[DS_NAMES]] = Field(
+        default=None,
+        description="subjects to run in one task, overrides dataset_name when given, 'all' means every subject"
+    )
     dataset_split: DS_SPLITS = Field(json_schema_extra={"default": getattr(DS_SPLITS, "test")})
     num_samples: int = Field(json_schema_extra={"default": -1})
+    sampling_seed: Optional[int] = Field(
+        default=None,
+        description="seed used to pick samples when num_samples is not -1, the same seed picks the same samples"
+    )
+    stratified_sampling: bool = Field(
+        default=False,
+        description="pick samples so that each answer keeps its proportion in the split"
+    )
+    streaming: bool = Field(
+        default=False,
+        description="read samples lazily from memory-mapped Arrow files instead of loading all of them into memory"
+    )
 
     def model_post_init(self, __context: Any) -> None:
         if self.num_samples < -1 or self.num_samples == 0:
             raise ValueError(f"num_samples should be -1 or positive, got {self.num_samples}")
+        if self.dataset_names is not None and not self.dataset_names:
+            raise ValueError("dataset_names should not be empty")
+
+    def get_subjects(self) -> List[str]:
+        subjects = []
+        for name in (self.dataset_names or [self.dataset_name]):
+            for subject in (ALL_SUBJECTS if name.value == "all" else [name.value]):
+                if subject not in subjects:
+                    subjects.append(subject)
+        return subjects
 
 
-def prepare_samples(ds_config: DatasetConfig) -> List[Dict[str, str]]:
+def _get_cache_dir(ds_config: DatasetConfig, subject: str) -> str:
+    cache_key = json.dumps(
+        {
+            "path": DS_PATH,
+            "name": subject,
+            "split": ds_config.dataset_split.value,
+            "prompt_template_version": PROMPT_TEMPLATE_VERSION
+        },
+        sort_keys=True
+    )
+    return os.path.join(DS_CACHE_DIR, hashlib.sha256(cache_key.encode("utf-8")).hexdigest())
+
+
+def _load_raw_dataset(ds_config: DatasetConfig, subject: str) -> Dataset:
+    return load_dataset(
+        path=DS_PATH,
+        split=ds_config.dataset_split.value,
+        name=subject,
+        keep_in_memory=True
+    )
+
+
+def _format_dataset(dataset: Dataset, subject: str) -> Dataset:
     def preprocess(samples):
-        sys_msg = f"The following are multiple choice questions (with answers) about {ds_config.dataset_name.value}."
+        sys_msg = f"The following are multiple choice questions (with answers) about {subject}."
         questions = samples["question"]
 
         choices = [
@@ -50,26 +106,122 @@ def prepare_samples(ds_config: DatasetConfig) -> List[Dict[str, str]]:
             f"{sys_msg}\n\n{question}\n{choice}" for question, choice in zip(questions, choices)
         ]
 
-        return {"question": new_questions, "answer": samples["answer"]}
+        return {
+            "question": new_questions,
+            "answer": [chr(65 + answer) for answer in samples["answer"]],
+            "subject": [subject] * len(new_questions)
+        }
 
-    dataset = load_dataset(
-        path=DS_PATH,
-        split=ds_config.dataset_split.value,
-        name=ds_config.dataset_name.value,
-        keep_in_memory=True
-    )
-    dataset = dataset.map(
+    return dataset.map(
         function=preprocess,
         keep_in_memory=True,
         remove_columns=[col for col in dataset.column_names if col not in [QUESTION_COL, ANSWER_COL]],
         batched=True
     )
-    samples: List[Dict[str, Union[str, int]]] = dataset.to_list()
-    if ds_config.num_samples != -1:
-        sample_indices = list(range(len(samples)))
-        samples = [dataset[i] for i in random.sample(sample_indices, min(len(sample_indices), ds_config.num_samples))]
-    samples = [{"question": s["question"], "answer": chr(65 + s["answer"])} for s in samples]
+
+
+def load_formatted_dataset(ds_config: DatasetConfig, subject: str) -> Dataset:
+    """
+    Load the formatted question, answer and subject of each sample of one subject, formatted samples are cached
+    as Arrow files under DS_CACHE_DIR, later runs load them memory-mapped without downloading or preprocessing again.
+    """
+    cache_dir = _get_cache_dir(ds_config, subject)
+    if os.path.exists(cache_dir):
+        try:
+            return load_from_disk(cache_dir)
+        except:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    dataset = _format_dataset(_load_raw_dataset(ds_config, subject), subject)
+
+    # write to a temporary directory first, so that a half written cache is never loaded
+    tmp_cache_dir = f"{cache_dir}.{os.getpid()}.tmp"
+    try:
+        dataset.save_to_disk(tmp_cache_dir)
+        os.replace(tmp_cache_dir, cache_dir)
+    except OSError:
+        # another task cached the same samples at the same time, or the cache dir is not writable
+        shutil.rmtree(tmp_cache_dir, ignore_errors=True)
+        return dataset
+    # reload so that the returned dataset is memory-mapped like a cache hit
+    return load_from_disk(cache_dir)
+
+
+def sample_indices(
+    num_rows: int,
+    num_samples: int,
+    seed: Optional[int] = None,
+    strata: Optional[List[Any]] = None
+) -> List[int]:
+    """
+    Randomly pick `num_samples` row indices, the same seed always picks the same indices.
+
+    When `strata` (one label per row) is given, each label gets a share of the samples proportional to its
+    number of rows, rounding is settled by the largest remainder.
+    """
+    rng = random.Random(seed)
+    num_samples = min(num_rows, num_samples)
+    if strata is None:
+        return rng.sample(range(num_rows), num_samples)
+
+    label2indices = defaultdict(list)
+    for i, label in enumerate(strata):
+        label2indices[label].append(i)
+    labels = sorted(label2indices)
+    shares = {label: num_samples * len(label2indices[label]) / num_rows for label in labels}
+    quotas = {label: int(shares[label]) for label in labels}
+    num_left = num_samples - sum(quotas.values())
+    for label in sorted(labels, key=lambda label_: quotas[label_] - shares[label_])[:num_left]:
+        quotas[label] += 1
+
+    indices = []
+    for label in labels:
+        indices.extend(rng.sample(label2indices[label], quotas[label]))
+    rng.shuffle(indices)
+    return indices
+
+
+def _prepare_subject_samples(ds_config: DatasetConfig, subject: str) -> Dataset:
+    if ds_config.num_samples == -1:
+        return load_formatted_dataset(ds_config, subject)
+
+    # without cache, only the picked rows are formatted, formatting the whole split isn't worth it for a sub-sample
+    is_cached = os.path.exists(_get_cache_dir(ds_config, subject))
+    dataset = load_formatted_dataset(ds_config, subject) if is_cached else _load_raw_dataset(ds_config, subject)
+    indices = sample_indices(
+        len(dataset),
+        ds_config.num_samples,
+        seed=ds_config.sampling_seed,
+        strata=dataset[ANSWER_COL] if ds_config.stratified_sampling else None
+    )
+    dataset = dataset.select(indices)
+    if not is_cached:
+        dataset = _format_dataset(dataset, subject)
+    return dataset
+
+
+def prepare_samples(ds_config: DatasetConfig) -> Union[List[Dict[str, str]], Dataset]:
+    """
+    Prepare samples of all subjects in the config one subject after another, `num_samples` applies to each subject.
+
+    Returns a list of formatted samples, or when `ds_config.streaming` is set, a Dataset backed by memory-mapped
+    Arrow files whose rows are only read when indexed.
+    """
+    datasets = [_prepare_subject_samples(ds_config, subject) for subject in ds_config.get_subjects()]
+    dataset = datasets[0] if len(datasets) == 1 else concatenate_datasets(datasets)
+    if ds_config.streaming:
+        return dataset
+    samples: List[Dict[str, str]] = dataset.to_list()
     return samples
 
 
-__all__ = ["QUESTION_COL", "ANSWER_COL", "DatasetConfig", "prepare_samples"]
+__all__ = [
+    "QUESTION_COL",
+    "ANSWER_COL",
+    "SUBJECT_COL",
+    "ALL_SUBJECTS",
+    "DatasetConfig",
+    "load_formatted_dataset",
+    "sample_indices",
+    "prepare_samples"
+]
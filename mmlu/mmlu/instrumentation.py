@@ -0,0 +1,73 @@
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Histogram
+
+
+SAMPLES_FINISHED = Counter(
+    "leaf_scene_samples_finished",
+    "Number of samples the scene finished, a sample is finished when all agents responded to it.",
+    ["scene"]
+)
+AGENT_ACTION_SECONDS = Histogram(
+    "leaf_agent_action_seconds",
+    "Time an agent spent on an action, for AI agents this is mostly LLM call latency.",
+    ["agent", "action"],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, float("inf"))
+)
+AGENT_ACTION_FAILURES = Counter(
+    "leaf_agent_action_failures",
+    "Number of agent actions that raised an exception.",
+    ["agent", "action"]
+)
+EVALUATION_FAILURES = Counter(
+    "leaf_evaluation_failures",
+    "Number of logs an evaluator failed to evaluate, their metrics are missing from the report.",
+    ["scene", "evaluator"]
+)
+RESPONSE_CACHE_LOOKUPS = Counter(
+    "leaf_response_cache_lookups",
+    "Number of LLM response cache lookups, by whether the response was cached.",
+    ["result"]
+)
+EMBEDDING_CACHE_LOOKUPS = Counter(
+    "leaf_embedding_cache_lookups",
+    "Number of texts looked up in the embedding cache, by whether their embedding was cached.",
+    ["result"]
+)
+RATE_LIMIT_WAIT_SECONDS = Histogram(
+    "leaf_rate_limit_wait_seconds",
+    "Time a request waited for the deployment's RPM and TPM quota before being sent.",
+    ["deployment"],
+    buckets=(0.01, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf"))
+)
+RATE_LIMIT_RETRIES = Counter(
+    "leaf_rate_limit_retries",
+    "Number of requests retried, by whether the server rate limited or failed them.",
+    ["deployment", "reason"]
+)
+
+
+@contextmanager
+def track_agent_action(agent_name: str, action: str):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        AGENT_ACTION_FAILURES.labels(agent=agent_name, action=action).inc()
+        raise
+    finally:
+        AGENT_ACTION_SECONDS.labels(agent=agent_name, action=action).observe(time.perf_counter() - start)
+
+
+__all__ = [
+    "SAMPLES_FINISHED",
+    "AGENT_ACTION_SECONDS",
+    "AGENT_ACTION_FAILURES",
+    "EVALUATION_FAILURES",
+    "RESPONSE_CACHE_LOOKUPS",
+    "EMBEDDING_CACHE_LOOKUPS",
+    "RATE_LIMIT_WAIT_SECONDS",
+    "RATE_LIMIT_RETRIES",
+    "track_agent_action"
+]
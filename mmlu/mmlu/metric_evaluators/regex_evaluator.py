@@ -1,4 +1,8 @@
-from typing import Dict, List, Optional
+import re
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
 
 from leaf_eval_tools.regex_answer_extractor import RegexAnswerExtractor, RegexAnswerExtractorConfig
 from leaf_playground.core.workers import MetricEvaluatorConfig, MetricEvaluator
@@ -13,6 +17,47 @@ from ..scene_definition import ExamineeAnswer, SCENE_DEFINITION
 ROLE_DEFINITION = SCENE_DEFINITION.get_role_definition("examinee")
 
 
+@lru_cache(maxsize=32)
+def _compile_rules(regex_rules: Tuple[str, ...], ignore_case: bool) -> List[re.Pattern]:
+    return [re.compile(rule, flags=re.IGNORECASE if ignore_case else 0) for rule in regex_rules]
+
+
+def score_answers(
+    answers: Sequence[str],
+    ground_truths: Sequence[str],
+    regex_config: RegexAnswerExtractorConfig
+) -> Tuple[np.ndarray, List[str]]:
+    """
+    Extract answers the same way RegexAnswerExtractor does and compare them to the ground truths in bulk.
+
+    Returns a boolean array telling whether each extracted answer starts with its ground truth, and the extracted
+    answers. Like RegexAnswerExtractor, a later rule is only tried on answers that no earlier rule matched.
+    """
+    if len(answers) != len(ground_truths):
+        raise ValueError(f"got {len(answers)} answers but {len(ground_truths)} ground truths")
+
+    extracted = [""] * len(answers)
+    unmatched = list(range(len(answers)))
+    for pattern in _compile_rules(tuple(regex_config.regex_rules), regex_config.ignore_case):
+        matches = map(pattern.search, [answers[i] for i in unmatched])
+        still_unmatched = []
+        for i, match in zip(unmatched, matches):
+            if match:
+                extracted[i] = match.group(1)
+            else:
+                still_unmatched.append(i)
+        unmatched = still_unmatched
+        if not unmatched:
+            break
+
+    if regex_config.ignore_case:
+        is_correct = map(str.startswith, map(str.lower, extracted), map(str.lower, ground_truths))
+    else:
+        is_correct = map(str.startswith, extracted, ground_truths)
+    is_correct = np.fromiter(is_correct, dtype=bool, count=len(extracted))
+    return is_correct, extracted
+
+
 class RegexEvaluatorConfig(MetricEvaluatorConfig):
     regex_eval_tool_config: RegexAnswerExtractorConfig = Field(default=...)
 
@@ -47,24 +92,24 @@ class RegexEvaluator(
         **kwargs,
     ) -> Dict[_MetricName, RecordOutput]:
         result = {}
-        if isinstance(response, ExamineeAnswer) and ground_truth:
+        if isinstance(response, ExamineeAnswer) and ground_truth and not response.failed:
             origin_answer = response.content.text
             ground_truth = ground_truth.text
             ignore_case = True
             misc = {
                 "question": references[0].content.text,
                 "agent_answer": origin_answer,
-                "ground_truth": ground_truth
+                "ground_truth": ground_truth,
+                "subject": getattr(references[0], "subject", None)
             }
             if isinstance(eval_tools[0], RegexAnswerExtractor):
-                answer = eval_tools[0](origin_answer)
-                ignore_case = eval_tools[0].ignore_case
-                misc["extracted_answer"] = answer
+                is_correct, extracted = score_answers([origin_answer], [ground_truth], eval_tools[0].config)
+                is_correct = bool(is_correct[0])
+                misc["extracted_answer"] = extracted[0]
             else:
                 answer = origin_answer
-
-            is_correct = answer.lower().startswith(
-                ground_truth.lower()) if ignore_case else answer.startswith(ground_truth)
+                is_correct = answer.lower().startswith(
+                    ground_truth.lower()) if ignore_case else answer.startswith(ground_truth)
 
             result["examinee.answer.accurate"] = RecordOutput(
                 record_value=is_correct,
@@ -72,6 +117,46 @@ class RegexEvaluator(
             )
         return result
 
+    @staticmethod
+    def score_batch(
+        answers: Sequence[str],
+        ground_truths: Sequence[str],
+        config: RegexEvaluatorConfig
+    ) -> Tuple[np.ndarray, List[str]]:
+        """Score many stored answers at once, e.g. when re-scoring a finished task offline."""
+        return score_answers(answers, ground_truths, config.regex_eval_tool_config)
+
+    @classmethod
+    def record_batch(
+        cls,
+        config: RegexEvaluatorConfig,
+        record_metrics: List[_MetricName],
+        responses: List[Message],
+        references: List[Optional[List[Message]]],
+        ground_truths: List[Optional[Text]]
+    ) -> List[Dict[_MetricName, RecordOutput]]:
+        """`_record` of many logs in one go, used by rescore, all answers are scored by one `score_batch` call."""
+        results = [{} for _ in responses]
+        indices = [
+            i for i, (response, ground_truth) in enumerate(zip(responses, ground_truths))
+            if isinstance(response, ExamineeAnswer) and ground_truth and not response.failed
+        ]
+        is_correct, extracted = cls.score_batch(
+            [responses[i].content.text for i in indices], [ground_truths[i].text for i in indices], config
+        )
+        for i, correct, extracted_answer in zip(indices, is_correct.tolist(), extracted):
+            results[i]["examinee.answer.accurate"] = RecordOutput(
+                record_value=correct,
+                misc={
+                    "question": references[i][0].content.text,
+                    "agent_answer": responses[i].content.text,
+                    "ground_truth": ground_truths[i].text,
+                    "subject": getattr(references[i][0], "subject", None),
+                    "extracted_answer": extracted_answer
+                }
+            )
+        return results
+
     @staticmethod
     async def _compare(
         response: Message,
@@ -84,6 +169,7 @@ class RegexEvaluator(
 
 
 __all__ = [
+    "score_answers",
     "RegexEvaluatorConfig",
     "RegexEvaluator"
 ]
@@ -41,7 +41,7 @@ class SimpleEvaluator(
         **kwargs,
     ) -> Dict[_MetricName, RecordOutput]:
         result = {}
-        if isinstance(response, ExamineeAnswer) and ground_truth:
+        if isinstance(response, ExamineeAnswer) and ground_truth and not response.failed:
             answer = response.content.text
             ground_truth = ground_truth.text
             result["examinee.answer.accurate"] = RecordOutput(
@@ -49,7 +49,8 @@ class SimpleEvaluator(
                 misc={
                     "question": references[0].content.text,
                     "agent_answer": answer,
-                    "ground_truth": ground_truth
+                    "ground_truth": ground_truth,
+                    "subject": getattr(references[0], "subject", None)
                 }
             )
         return result
@@ -0,0 +1,309 @@
+"""
+Re-score a finished task offline: load the logs a task saved to its results dir, replay them through the given
+metric evaluators and regenerate metrics.json and charts.json, without calling any agent again.
+
+    python -m mmlu.rescore <results_dir> --evaluators evaluators.json [--workers 4] [--output_dir <dir>]
+
+`evaluators.json` holds a list of {"evaluator_obj": ..., "evaluator_config_data": {...}}, where "evaluator_obj" is
+either an evaluator class name of this project, e.g. "RegexEvaluator", or a full dynamic object like
+{"obj": "RegexEvaluator", "module": "mmlu.metric_evaluators.regex_evaluator"}.
+
+Evaluators that have a `record_batch` classmethod, and no comparison metric enabled, score all logs in one call in
+this process. The others are run as they are in a task, logs are sent one by one to their worker processes.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+from typing import Any, Dict, List, Optional, Type
+
+from pydantic import TypeAdapter
+
+from leaf_playground.core.scene_definition import MetricDefinition, SceneConfig, VALUE_DETYPE_2_DEFAULT_VALUE
+from leaf_playground.core.scene_engine import MetricEvaluatorObjsConfig, ReporterObjConfig
+from leaf_playground.core.workers import Logger, MetricEvaluator, MetricEvaluatorConfig, MetricReporter
+from leaf_playground.data.log_body import ActionLogBody, LogType
+from leaf_playground.data.message import MessagePool
+from leaf_playground.utils.import_util import dynamically_import_obj
+from leaf_playground.utils.type_util import validate_type
+
+from .scene import MmluScene as SceneCls
+from .scene_definition import MessageType
+
+PROJECT_CONFIG_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".leaf", "project_config.json"
+)
+LOG_FILE_NAMES = [".log.jsonl", ".log.json"]
+
+
+def _load_project_metadata() -> dict:
+    with open(PROJECT_CONFIG_PATH, "r", encoding="utf-8") as f:
+        return json.load(f)["metadata"]
+
+
+def load_logs(logs_path: str) -> List[dict]:
+    with open(logs_path, "r", encoding="utf-8") as f:
+        if logs_path.endswith(".jsonl"):
+            return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
+
+
+def find_logs_path(results_dir: str) -> str:
+    for file_name in LOG_FILE_NAMES:
+        logs_path = os.path.join(results_dir, file_name)
+        if os.path.exists(logs_path):
+            return logs_path
+    raise FileNotFoundError(f"none of {LOG_FILE_NAMES} found in {results_dir}, pass the log file by --logs")
+
+
+def restore_logs(log_dicts: List[dict], message_pool: MessagePool) -> List[ActionLogBody]:
+    """
+    Put messages inlined in exported logs back into the message pool and rebuild action logs that reference them by
+    id, records of the original run are dropped except human ones.
+    """
+    message_adapter = TypeAdapter(MessageType)
+    logs = []
+    for log_dict in log_dicts:
+        if str(log_dict.get("log_type", "")).lower() != LogType.ACTION.value:
+            continue
+        log_dict = dict(log_dict)
+        response = message_adapter.validate_python(log_dict["response"])
+        message_pool.put_message(response)
+        log_dict["response"] = response.id
+        if log_dict.get("references"):
+            references = [message_adapter.validate_python(ref) for ref in log_dict["references"]]
+            for reference in references:
+                message_pool.put_message(reference)
+            log_dict["references"] = [reference.id for reference in references]
+        for field_name in ["eval_records", "compare_records", "human_compare_records"]:
+            log_dict.pop(field_name, None)
+        logs.append(SceneCls.log_body_class.model_validate(log_dict))
+    return logs
+
+
+def load_evaluators_config(evaluators_path: str, workers: Optional[int]) -> MetricEvaluatorObjsConfig:
+    with open(evaluators_path, "r", encoding="utf-8") as f:
+        data: Any = json.load(f)
+    evaluators: List[Dict[str, Any]] = data["evaluators"] if isinstance(data, dict) else data
+
+    name2obj = {
+        evaluator_metadata["cls_name"]: evaluator_metadata["obj_for_import"]
+        for evaluator_metadata in _load_project_metadata()["evaluators_metadata"] or []
+    }
+    for evaluator in evaluators:
+        if isinstance(evaluator["evaluator_obj"], str):
+            evaluator["evaluator_obj"] = name2obj[evaluator["evaluator_obj"]]
+        if workers:
+            evaluator["evaluator_config_data"]["max_concurrency"] = workers
+    return MetricEvaluatorObjsConfig(evaluators=evaluators)
+
+
+def _enabled_metric_defs(
+    evaluator_cls: Type[MetricEvaluator],
+    scene_config: SceneConfig
+) -> Dict[str, MetricDefinition]:
+    return {
+        metric_def.belonged_chain: metric_def
+        for metric_def in evaluator_cls.metric_definitions
+        if scene_config.get_metric_config(metric_def.belonged_chain).enable
+    }
+
+
+def can_score_in_process(evaluator_cls: Type[MetricEvaluator], scene_config: SceneConfig) -> bool:
+    return hasattr(evaluator_cls, "record_batch") and not any(
+        metric_def.is_comparison for metric_def in _enabled_metric_defs(evaluator_cls, scene_config).values()
+    )
+
+
+async def score_in_process(
+    logs: List[ActionLogBody],
+    evaluator_cls: Type[MetricEvaluator],
+    config: MetricEvaluatorConfig,
+    scene_config: SceneConfig,
+    logger: Logger,
+    reporter: MetricReporter
+) -> None:
+    """
+    Score all logs by one `record_batch` call of the evaluator class and put the records the way
+    `MetricEvaluator.record` does, without starting any evaluator process.
+    """
+    metric_defs = _enabled_metric_defs(evaluator_cls, scene_config)
+    resp_types = {metric_def.expect_resp_msg_type for metric_def in metric_defs.values()}
+    resp_types.update(config.non_ignored_message_type or [])
+    message_pool = logger.message_pool
+    logs = [log for log in logs if type(message_pool.get_message_by_id(log.response)) in resp_types]
+    responses = [message_pool.get_message_by_id(log.response) for log in logs]
+    references = [[message_pool.get_message_by_id(ref) for ref in (log.references or [])] or None for log in logs]
+
+    # evaluators may run an event loop of their own while scoring, e.g. ragas does
+    outputs = await asyncio.get_running_loop().run_in_executor(
+        None,
+        evaluator_cls.record_batch,
+        config,
+        list(metric_defs),
+        responses,
+        references,
+        [log.ground_truth for log in logs]
+    )
+
+    record_data_models = {
+        metric_name: metric_def.create_data_models()[1] for metric_name, metric_def in metric_defs.items()
+    }
+    for log, response, record_outputs in zip(logs, responses, outputs):
+        records = {}
+        for metric_name, record_output in record_outputs.items():
+            if metric_name not in metric_defs:
+                continue
+            expect_dtype = metric_defs[metric_name].record_value_dtype
+            if not validate_type(record_output.record_value, VALUE_DETYPE_2_DEFAULT_VALUE[expect_dtype]):
+                continue
+            record_data = record_data_models[metric_name](
+                value=record_output.record_value,
+                reason=record_output.reason,
+                misc=record_output.misc,
+                target_agent=response.sender_id,
+                evaluator=evaluator_cls.__name__,
+            )
+            reporter.put_record(record_data, metric_name, log.id)
+            records[metric_name] = record_data.model_dump(mode="json")
+        logger.add_action_log_record(log_id=log.id, records=records, field_name="eval_records")
+
+
+async def replay(
+    logs: List[ActionLogBody],
+    evaluators: List[MetricEvaluator],
+    reporter: MetricReporter,
+    max_logs_in_flight: int
+) -> None:
+    # evaluators poll for each result, so only let a bounded number of logs wait at once
+    semaphore = asyncio.Semaphore(max_logs_in_flight)
+
+    async def replay_one(log: ActionLogBody) -> None:
+        async with semaphore:
+            await asyncio.gather(
+                *[evaluator.record(log) for evaluator in evaluators if evaluator.metrics_for_record],
+                *[evaluator.compare(log) for evaluator in evaluators if evaluator.metrics_for_compare]
+            )
+
+    for log in logs:
+        for metric_name, record in log.human_eval_records.items():
+            _, record_data_model = reporter.metric_definitions[metric_name].create_data_models()
+            reporter.put_human_record(record_data_model(**record), metric_name, log.id)
+
+    for evaluator in evaluators:
+        evaluator.start()
+    try:
+        await asyncio.gather(*[replay_one(log) for log in logs])
+        for evaluator in evaluators:
+            evaluator.notify_can_stop()
+        await asyncio.gather(*[evaluator.join() for evaluator in evaluators])
+    finally:
+        for evaluator in evaluators:
+            evaluator.terminate()
+
+
+def _dump_metrics(metrics: dict) -> dict:
+    return {
+        metrics_type: {
+            name: [each.model_dump(mode="json") for each in data] if isinstance(data, list)
+            else data.model_dump(mode="json")
+            for name, data in metrics_data.items()
+        }
+        for metrics_type, metrics_data in metrics.items()
+    }
+
+
+async def rescore(
+    results_dir: str,
+    evaluators_path: str,
+    output_dir: Optional[str] = None,
+    logs_path: Optional[str] = None,
+    workers: Optional[int] = None,
+    max_logs_in_flight: int = 256
+) -> dict:
+    with open(os.path.join(results_dir, "scene_config.json"), "r", encoding="utf-8") as f:
+        scene_config: SceneConfig = SceneCls.config_cls(**json.load(f))
+
+    message_pool = MessagePool()
+    logger = Logger()
+    logs = restore_logs(load_logs(logs_path or find_logs_path(results_dir)), message_pool)
+    for log in logs:
+        logger.add_log(log)
+
+    reporter = ReporterObjConfig(
+        charts=[
+            chart_metadata["obj_for_import"] for chart_metadata in _load_project_metadata()["charts_metadata"] or []
+        ]
+    ).initialize_reporter(scene_definition=SceneCls.scene_definition)
+    evaluator_configs = []
+    evaluators = []
+    for evaluator_obj_config in load_evaluators_config(evaluators_path, workers).evaluators:
+        evaluator_cls: Type[MetricEvaluator] = dynamically_import_obj(evaluator_obj_config.evaluator_obj)
+        config = evaluator_cls.config_cls(**evaluator_obj_config.evaluator_config_data)
+        evaluator_configs.append(config)
+        if can_score_in_process(evaluator_cls, scene_config):
+            await score_in_process(logs, evaluator_cls, config, scene_config, logger, reporter)
+        else:
+            evaluators.append(
+                evaluator_cls(config=config, scene_config=scene_config, logger=logger, reporter=reporter)
+            )
+
+    await replay(logs, evaluators, reporter, max_logs_in_flight)
+
+    metrics, charts = reporter.generate_reports(
+        scene_config=scene_config,
+        evaluator_configs=evaluator_configs,
+        logs=logger.logs
+    )
+    metrics = _dump_metrics(metrics)
+
+    output_dir = output_dir or os.path.join(results_dir, "rescored")
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, "evaluator_configs.json"), "w", encoding="utf-8") as f:
+        json.dump([config.model_dump(mode="json") for config in evaluator_configs], f, indent=4, ensure_ascii=False)
+    with open(os.path.join(output_dir, "metrics.json"), "w", encoding="utf-8") as f:
+        json.dump(metrics, f, indent=4, ensure_ascii=False)
+    with open(os.path.join(output_dir, "charts.json"), "w", encoding="utf-8") as f:
+        json.dump(charts, f, indent=4, ensure_ascii=False)
+    return metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(description="re-score a finished task's logs with other metric evaluators")
+    parser.add_argument("results_dir", type=str, help="the dir the task saved its results to")
+    parser.add_argument("--evaluators", type=str, required=True, help="a JSON file of evaluators to re-score with")
+    parser.add_argument("--output_dir", type=str, default=None, help="defaults to <results_dir>/rescored")
+    parser.add_argument("--logs", type=str, default=None, help="an exported .json or .jsonl log file to read instead")
+    parser.add_argument("--workers", type=int, default=None, help="overrides each evaluator's max_concurrency")
+    parser.add_argument("--max_logs_in_flight", type=int, default=256)
+    args = parser.parse_args()
+
+    metrics = asyncio.run(
+        rescore(
+            results_dir=args.results_dir,
+            evaluators_path=args.evaluators,
+            output_dir=args.output_dir,
+            logs_path=args.logs,
+            workers=args.workers,
+            max_logs_in_flight=args.max_logs_in_flight
+        )
+    )
+    for name, data in metrics["merged_metrics"].items():
+        for each in data if isinstance(data, list) else [data]:
+            print(f"{name} {each.get('target_agent') or ''}: {each['value']}")
+
+
+__all__ = [
+    "load_logs",
+    "restore_logs",
+    "load_evaluators_config",
+    "can_score_in_process",
+    "score_in_process",
+    "replay",
+    "rescore"
+]
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 import asyncio
 from typing import List, Optional
 
+from leaf_playground._config import _Config
 from leaf_playground.core.workers import Logger
 from leaf_playground.core.scene import Scene
 from leaf_playground.core.scene_definition import SceneConfig
@@ -11,6 +12,7 @@ from pydantic import Field
 from .agents.examiner import Examiner
 from .agents.base_examinee import AIBaseExaminee
 from .dataset_util import *
+from .instrumentation import SAMPLES_FINISHED, track_agent_action
 from .scene_definition import *
 
 
@@ -18,10 +20,24 @@ class MmluSceneLogBody(ActionLogBody):
     ground_truth: Optional[Text] = Field(default=None)
 
 
+class SchedulerConfig(_Config):
+    max_samples_in_flight: int = Field(
+        default=1,
+        ge=1,
+        description="how many samples can be sent before all examinees answered the earliest one"
+    )
+    max_concurrency_per_examinee: int = Field(
+        default=1,
+        ge=1,
+        description="how many samples an examinee can answer at the same time"
+    )
+
+
 MmluSceneConfig = SceneConfig.create_config_model(
     SCENE_DEFINITION,
     additional_config_fields={
-        "dataset_config": (DatasetConfig, Field(default=...))
+        "dataset_config": (DatasetConfig, Field(default=...)),
+        "scheduler_config": (SchedulerConfig, Field(default_factory=SchedulerConfig))
     }
 )
 
@@ -41,52 +57,98 @@ class MmluScene(
         self.examinees: List[AIBaseExaminee] = self.agents["examinee"]
 
     async def _run(self):
-        async def examinee_answer(examinee: AIBaseExaminee, s: ExaminerSample) -> None:
+        scheduler_config: SchedulerConfig = self.config.scheduler_config
+        # released once a sample's logs are written, bounds how far the examiner can get ahead of examinees
+        window = asyncio.Semaphore(scheduler_config.max_samples_in_flight)
+        examinee_semaphores = {
+            examinee.id: asyncio.Semaphore(scheduler_config.max_concurrency_per_examinee)
+            for examinee in self.examinees
+        }
+        # samples in the order they were sent, with the task answering them
+        answering = asyncio.Queue()
+
+        async def examinee_answer(examinee: AIBaseExaminee, s: ExaminerSample) -> ExamineeAnswer:
             try:
-                answer: ExamineeAnswer = await examinee.answer(sample=s, examiner=self.examiner.profile)
+                async with examinee_semaphores[examinee.id]:
+                    with track_agent_action(examinee.name, "answer"):
+                        answer: ExamineeAnswer = await examinee.answer(sample=s, examiner=self.examiner.profile)
             except:
                 answer: ExamineeAnswer = ExamineeAnswer(
                     sender=examinee.profile,
                     receivers=[self.examiner.profile],
                     content=Text(text=""),
-                    sample_id=s.sample_id
+                    sample_id=s.sample_id,
+                    failed=True
                 )
-            self.message_pool.put_message(answer)
-            ground_truth = self.examiner.get_golden_answer(s.sample_id)
-            log = self.log_body_class(
-                references=[s.id],
-                response=answer.id,
-                ground_truth=Text(text=ground_truth) if ground_truth else None,
-                log_msg=f"examinee [{examinee.name}] answers to sample [{s.sample_id}]",
-                action_belonged_chain=examinee.role_definition.get_action_definition("answer").belonged_chain
-            )
-            self.logger.add_log(log)
-            self.notify_evaluators_record(log)
+            return answer
 
-        await self.examiner.prepare_samples(self.config.dataset_config)
-        while not self.examiner.check_examine_finish():
-            sample: ExaminerSample = await self.examiner.send_sample(
-                receivers=[examinee.profile for examinee in self.examinees]
-            )
-            self.message_pool.put_message(sample)
+        def write_logs(s: ExaminerSample, answers: List[ExamineeAnswer]) -> None:
             self.logger.add_log(
                 self.log_body_class(
                     references=None,
-                    response=sample.id,
+                    response=s.id,
                     ground_truth=None,
-                    log_msg=f"examiner sends sample [{sample.sample_id}] to all examinees",
+                    log_msg=f"examiner sends sample [{s.sample_id}] to all examinees",
                     action_belonged_chain=self.examiner.role_definition.get_action_definition(
                         "send_sample"
                     ).belonged_chain
                 )
             )
+            ground_truth = self.examiner.get_golden_answer(s.sample_id)
+            for examinee, answer in zip(self.examinees, answers):
+                self.message_pool.put_message(answer)
+                log = self.log_body_class(
+                    references=[s.id],
+                    response=answer.id,
+                    ground_truth=Text(text=ground_truth) if ground_truth else None,
+                    log_msg=f"examinee [{examinee.name}] "
+                            f"{'failed to answer' if answer.failed else 'answers to'} sample [{s.sample_id}]",
+                    action_belonged_chain=examinee.role_definition.get_action_definition("answer").belonged_chain
+                )
+                self.logger.add_log(log)
+                self.notify_evaluators_record(log)
 
-            await asyncio.gather(
-                *[examinee_answer(examinee, sample) for examinee in self.examinees]
-            )
+        async def write_logs_in_order() -> None:
+            # samples may be answered out of order, logs are still written in the order samples were sent
+            while True:
+                item = await answering.get()
+                if item is None:
+                    return
+                s, answer_task = item
+                write_logs(s, await answer_task)
+                SAMPLES_FINISHED.labels(scene=self.__class__.__name__).inc()
+                window.release()
+
+        await self.examiner.prepare_samples(self.config.dataset_config)
+        writer_task = asyncio.ensure_future(write_logs_in_order())
+        # wake up the loop below if the writer stops early
+        writer_task.add_done_callback(lambda _: window.release())
+        answer_tasks = set()
+        try:
+            while not self.examiner.check_examine_finish():
+                await window.acquire()
+                if writer_task.done():
+                    break
+                sample: ExaminerSample = await self.examiner.send_sample(
+                    receivers=[examinee.profile for examinee in self.examinees]
+                )
+                self.message_pool.put_message(sample)
+                answer_task = asyncio.ensure_future(
+                    asyncio.gather(*[examinee_answer(examinee, sample) for examinee in self.examinees])
+                )
+                answer_tasks.add(answer_task)
+                answer_task.add_done_callback(answer_tasks.discard)
+                answering.put_nowait((sample, answer_task))
+            answering.put_nowait(None)
+            await writer_task
+        finally:
+            writer_task.cancel()
+            for answer_task in list(answer_tasks):
+                answer_task.cancel()
 
 
 __all__ = [
+    "SchedulerConfig",
     "MmluSceneConfig",
     "MmluScene"
 ]
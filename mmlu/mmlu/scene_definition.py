@@ -1,4 +1,4 @@
-from typing import List, Literal, Union
+from typing import List, Literal, Optional, Union
 from typing_extensions import Annotated
 
 from leaf_playground.core.scene_definition import *
@@ -7,9 +7,11 @@ from leaf_playground.data.message import TextMessage
 from leaf_playground.data.profile import Profile
 from pydantic import Field
 
+from .aggregation import MeanAggregator, incremental_aggregator
 from .dataset_util import DatasetConfig
 
 
+@incremental_aggregator(lambda: MeanAggregator(ndigits=8))
 def accuracy_fn(records: List[_RecordData]) -> AggregationMethodOutput:
     num_records = len(records)
     num_accurate = len([record for record in records if bool(record.value)])
@@ -19,11 +21,13 @@ def accuracy_fn(records: List[_RecordData]) -> AggregationMethodOutput:
 
 class ExaminerSample(TextMessage):
     sample_id: int = Field(default=...)
+    subject: Optional[str] = Field(default=None)
     msg_type: Literal["sample"] = Field(default="sample")
 
 
 class ExamineeAnswer(TextMessage):
     sample_id: int = Field(default=...)
+    failed: bool = Field(default=False, description="the examinee raised instead of answering, it isn't scored")
     msg_type: Literal["answer"] = Field(default="answer")
 
 
@@ -109,6 +113,7 @@ SCENE_DEFINITION = SceneDefinition(
 )
 
 __all__ = [
+    "accuracy_fn",
     "ExaminerSample",
     "ExamineeAnswer",
     "MessageType",
@@ -1,8 +1,9 @@
-from typing import List, Optional
+from typing import List, Optional, Union
 
+from datasets import Dataset
 from leaf_playground.core.scene_agent import SceneStaticAgentConfig, SceneStaticAgent
 from leaf_playground.data.profile import Profile
-from leaf_playground.data.media import Text
+from leaf_playground.data.media import Json, Text
 
 from ..scene_definition import ExaminerQuestion, SCENE_DEFINITION
 from ..dataset_utils import prepare_dataset, DatasetConfig
@@ -20,7 +21,10 @@ class Examiner(SceneStaticAgent, role_definition=ROLE_DEFINITION, cls_descriptio
         super().__init__(config=config)
 
         self._cur = 0
-        self._questions = []
+        # a list of rows, or a memory-mapped Dataset in streaming mode, both are indexed by question id
+        self._questions: Union[List[dict], Dataset] = []
+        # one ground truth per question, built once and shared by all examinees' logs, None in streaming mode
+        self._ground_truths: Optional[List[Optional[Json]]] = None
         self._dataset_config: DatasetConfig = None
 
     def prepare_questions(
@@ -30,6 +34,11 @@ class Examiner(SceneStaticAgent, role_definition=ROLE_DEFINITION, cls_descriptio
         self._cur = 0
         self._questions = prepare_dataset(dataset_config)
         self._dataset_config = dataset_config
+        if dataset_config.streaming:
+            # building them all would read every row, so they are built when asked for
+            self._ground_truths = None
+        else:
+            self._ground_truths = [self._build_ground_truth(row) for row in self._questions]
 
     def send_question(self, receivers: List[Profile]) -> ExaminerQuestion:
         question = ExaminerQuestion(
@@ -44,13 +53,25 @@ class Examiner(SceneStaticAgent, role_definition=ROLE_DEFINITION, cls_descriptio
     def check_examine_finish(self) -> bool:
         return self._cur >= len(self._questions)
 
-    def get_golden_answer(self, question_id: int) -> Optional[dict]:
-        result = {}
+    def _build_ground_truth(self, row: dict) -> Optional[Json]:
+        data = {}
         if self._dataset_config.golden_answer_column:
-            result['golden_answer'] = self._questions[question_id][self._dataset_config.golden_answer_column]
+            data['golden_answer'] = row[self._dataset_config.golden_answer_column]
         if self._dataset_config.ground_truth_column:
-            result['ground_truths'] = self._questions[question_id][self._dataset_config.ground_truth_column]
-        return result
+            ground_truths = row[self._dataset_config.ground_truth_column]
+            # ragas expects a list of strings
+            data['ground_truths'] = [ground_truths] if isinstance(ground_truths, str) else list(ground_truths or [])
+        return Json(data=data) if data else None
+
+    def get_ground_truth(self, question_id: int) -> Optional[Json]:
+        """The question's ground truth, the same object for every call, so don't modify it."""
+        if self._ground_truths is not None:
+            return self._ground_truths[question_id]
+        return self._build_ground_truth(self._questions[question_id])
+
+    def get_golden_answer(self, question_id: int) -> Optional[dict]:
+        ground_truth = self.get_ground_truth(question_id)
+        return dict(ground_truth.data) if ground_truth else {}
 
 
 __all__ = [
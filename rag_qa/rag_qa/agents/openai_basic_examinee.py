@@ -15,6 +15,8 @@ from .base_examinee import (
     AIBaseExaminee,
     AIBaseExamineeConfig
 )
+from ..rate_limiter import RateLimitConfig
+from ..response_cache import ResponseCacheConfig, create_chat_completion
 from ..scene_definition import ExamineeAnswer, ExaminerQuestion
 
 
@@ -41,6 +43,8 @@ class CustomOpenAIBackendConfig(OpenAIBackendConfig):
 class OpenAIBasicExamineeConfig(AIBaseExamineeConfig):
     ai_backend_config: CustomOpenAIBackendConfig = Field(default=...)
     ai_backend_cls: Type[OpenAIBackend] = Field(default=OpenAIBackend)
+    response_cache_config: ResponseCacheConfig = Field(default_factory=ResponseCacheConfig)
+    rate_limit_config: RateLimitConfig = Field(default_factory=RateLimitConfig)
 
 
 class OpenAIBasicExaminee(AIBaseExaminee, cls_description="Examinee agent using OpenAI API to answer questions"):
@@ -66,7 +70,10 @@ class OpenAIBasicExaminee(AIBaseExaminee, cls_description="Examinee agent using
 
         resp_format = {"type": "json_object"} if model.find("gpt-4") >= 0 else {"type": "text"}
         try:
-            resp = await self.backend.async_client.chat.completions.create(
+            resp = await create_chat_completion(
+                self.backend.async_client,
+                self.config.response_cache_config,
+                rate_limit_config=self.config.rate_limit_config,
                 messages=[
                     ChatCompletionSystemMessageParam(role="system", content=system_msg),
                     ChatCompletionUserMessageParam(role="user", content=examiner_msg),
@@ -80,11 +87,11 @@ class OpenAIBasicExaminee(AIBaseExaminee, cls_description="Examinee agent using
             resp = None
 
         try:
-            obj = json.loads(resp.choices[0].message.content) if resp else {}
+            obj = json.loads(resp) if resp else {}
         except Exception as e:
             print(f'Response Not JSON: {e}')
             obj = {
-                "answer": resp.choices[0].message.content,
+                "answer": resp,
                 "contexts": ['nothing found']  # default for ragas data type validation
             }
 
@@ -1,12 +1,21 @@
+import hashlib
+import inspect
+import json
+import os
 import random
-from typing import Optional, List, Any
+import shutil
+from types import CodeType
+from typing import Callable, Optional, List, Any, Union
 
-from datasets import load_dataset
+from datasets import Dataset, load_dataset, load_from_disk
+from datasets.fingerprint import Hasher
 from pydantic import Field
 
 from leaf_playground._config import _Config
 from leaf_playground.utils.import_util import dynamically_import_fn, DynamicFn
 
+DS_CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "dataset", "rag_qa_cache")
+
 
 class DatasetConfig(_Config):
     path: str = Field(default="explodinggradients/fiqa")
@@ -20,40 +29,173 @@ class DatasetConfig(_Config):
     name: Optional[str] = Field(default=None)
     data_dir: Optional[str] = Field(default=None)
     data_files: Optional[List[str]] = Field(default=None)
+    streaming: bool = Field(
+        default=False,
+        description="read questions lazily from memory-mapped Arrow files instead of loading all of them into memory"
+    )
+    num_proc: Optional[int] = Field(
+        default=None,
+        ge=1,
+        description="how many processes filter and preprocess questions, one when not set"
+    )
+    use_cache: bool = Field(
+        default=True,
+        description="cache filtered and preprocessed questions under dataset/rag_qa_cache, so later tasks with the "
+                    "same dataset, filters and preprocessor skip them"
+    )
 
     def model_post_init(self, __context: Any) -> None:
         if self.num_questions < -1 or self.num_questions == 0:
             raise ValueError(f"num_questions should be -1 or positive, got {self.num_questions}")
 
 
-def prepare_dataset(config: DatasetConfig) -> List[dict]:
+def _code_bytes(code: CodeType) -> bytes:
+    return code.co_code + b"".join(
+        _code_bytes(const) if isinstance(const, CodeType) else repr(const).encode("utf-8") for const in code.co_consts
+    )
+
+
+def _fingerprint(fn: Callable) -> str:
+    # Hasher pickles module-level functions by reference, so their source (or bytecode and constants when the source
+    # isn't available) is hashed too, editing a filter or preprocessor then invalidates caches
+    try:
+        code = inspect.getsource(fn)
+    except (OSError, TypeError):
+        code = _code_bytes(fn.__code__) if hasattr(fn, "__code__") else None
+    return Hasher.hash([getattr(fn, "__module__", None), getattr(fn, "__qualname__", None), code, Hasher.hash(fn)])
+
+
+def _get_cache_dir(config: DatasetConfig, filter_fns: List[Callable], preprocessor: Optional[Callable]) -> str:
+    data_files = []
+    for data_file in (config.data_files or []):
+        # local files are also keyed by their size and modification time, so changing them invalidates caches
+        stat = os.stat(data_file) if os.path.isfile(data_file) else None
+        data_files.append([data_file, stat.st_size, stat.st_mtime] if stat else data_file)
+    cache_key = json.dumps(
+        {
+            "path": config.path,
+            "split": config.split,
+            "name": config.name,
+            "data_dir": config.data_dir,
+            "data_files": data_files,
+            "filter_conditions": [_fingerprint(fn) for fn in filter_fns],
+            "question_preprocessor": _fingerprint(preprocessor) if preprocessor else None
+        },
+        sort_keys=True
+    )
+    return os.path.join(DS_CACHE_DIR, hashlib.sha256(cache_key.encode("utf-8")).hexdigest())
+
+
+def _fuse_filters(filter_fns: List[Callable]) -> Callable:
+    """
+    Combine batched filter functions into one, so rows are filtered in a single pass. Like chained filters, each
+    function only sees the rows all previous ones kept.
+    """
+    if len(filter_fns) == 1:
+        return filter_fns[0]
+
+    def fused_filter(batch) -> List[bool]:
+        num_rows = len(next(iter(batch.values())))
+        indices = list(range(num_rows))
+        for filter_fn in filter_fns:
+            if len(indices) == num_rows:
+                keep = filter_fn(batch)
+            else:
+                keep = filter_fn({column: [values[i] for i in indices] for column, values in batch.items()})
+            indices = [i for i, keep_row in zip(indices, keep) if keep_row]
+            if not indices:
+                break
+        mask = [False] * num_rows
+        for i in indices:
+            mask[i] = True
+        return mask
+
+    return fused_filter
+
+
+def _load_processed_dataset(
+    config: DatasetConfig,
+    filter_fns: List[Callable],
+    preprocessor: Optional[Callable]
+) -> Dataset:
+    keep_in_memory = not config.streaming
     dataset = load_dataset(
         path=config.path,
         split=config.split,
         name=config.name,
         data_dir=config.data_dir,
         data_files=config.data_files,
-        keep_in_memory=True
+        keep_in_memory=keep_in_memory
     )
-    for condition in (config.filter_conditions or []):
+    if filter_fns:
         dataset = dataset.filter(
-            function=dynamically_import_fn(condition),
+            function=_fuse_filters(filter_fns),
             batched=True,
-            keep_in_memory=True
+            keep_in_memory=keep_in_memory,
+            num_proc=config.num_proc
         )
-    if config.question_preprocessor:
+    if preprocessor:
         dataset = dataset.map(
-            function=dynamically_import_fn(config.question_preprocessor),
+            function=preprocessor,
             batched=True,
-            keep_in_memory=True
+            keep_in_memory=keep_in_memory,
+            num_proc=config.num_proc
         )
-    dataset = dataset.to_list()
-    if config.num_questions != -1:
-        data_indices = list(range(len(dataset)))
-        dataset = [dataset[i] for i in random.sample(data_indices, min(len(data_indices), config.num_questions))]
     return dataset
 
 
+def _load_cached_dataset(
+    config: DatasetConfig,
+    filter_fns: List[Callable],
+    preprocessor: Optional[Callable]
+) -> Dataset:
+    cache_dir = _get_cache_dir(config, filter_fns, preprocessor)
+    if os.path.exists(cache_dir):
+        try:
+            return load_from_disk(cache_dir)
+        except:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    dataset = _load_processed_dataset(config, filter_fns, preprocessor)
+
+    # write to a temporary directory first, so that a half written cache is never loaded
+    tmp_cache_dir = f"{cache_dir}.{os.getpid()}.tmp"
+    try:
+        dataset.save_to_disk(tmp_cache_dir)
+        os.replace(tmp_cache_dir, cache_dir)
+    except OSError:
+        # another task cached the same questions at the same time, or the cache dir is not writable
+        shutil.rmtree(tmp_cache_dir, ignore_errors=True)
+        return dataset
+    # reload so that the returned dataset is memory-mapped like a cache hit
+    return load_from_disk(cache_dir)
+
+
+def prepare_dataset(config: DatasetConfig) -> Union[List[dict], Dataset]:
+    """
+    Load, filter, preprocess and sample questions.
+
+    Filtered and preprocessed questions are cached as Arrow files under DS_CACHE_DIR, keyed by the dataset and the
+    code of filters and preprocessor, later tasks load them memory-mapped without processing them again.
+
+    Returns a list of rows, or when `config.streaming` is set, a Dataset backed by memory-mapped Arrow files, whose
+    rows are only read when indexed.
+    """
+    filter_fns = [dynamically_import_fn(condition) for condition in (config.filter_conditions or [])]
+    preprocessor = dynamically_import_fn(config.question_preprocessor) if config.question_preprocessor else None
+    if config.use_cache and (filter_fns or preprocessor):
+        dataset = _load_cached_dataset(config, filter_fns, preprocessor)
+    else:
+        # nothing to process, load_dataset already caches the raw dataset
+        dataset = _load_processed_dataset(config, filter_fns, preprocessor)
+    if config.num_questions != -1:
+        data_indices = range(len(dataset))
+        dataset = dataset.select(random.sample(data_indices, min(len(data_indices), config.num_questions)))
+    if config.streaming:
+        return dataset
+    return dataset.to_list()
+
+
 __all__ = [
     "prepare_dataset",
     "DatasetConfig"
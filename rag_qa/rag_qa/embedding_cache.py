@@ -0,0 +1,289 @@
+import hashlib
+import os
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Literal, Optional
+
+import numpy as np
+from pydantic import Field
+from ragas.embeddings.base import BaseRagasEmbeddings
+from ragas.run_config import RunConfig
+
+from leaf_playground._config import _Config
+
+from .instrumentation import EMBEDDING_CACHE_LOOKUPS
+
+try:
+    import fcntl
+except ImportError:  # not on POSIX, worker processes then shouldn't share one cache_dir
+    fcntl = None
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache", "embeddings"
+)
+
+
+class EmbeddingCacheConfig(_Config):
+    mode: Literal["memory", "disk", "off"] = Field(
+        default="memory",
+        description="memory keeps embeddings in an in-memory LRU, disk also stores them under cache_dir so they are "
+                    "reused by other worker processes and later tasks, off embeds every text every time"
+    )
+    cache_dir: Optional[str] = Field(
+        default=None,
+        description="dir embeddings are stored in when mode is disk, defaults to .cache/embeddings under the project "
+                    "directory"
+    )
+    memory_size: int = Field(
+        default=8192,
+        ge=0,
+        description="how many embeddings are kept in memory, least recently used ones are dropped first"
+    )
+
+
+class _DiskStore:
+    """
+    Embeddings of one dimension stored as float16 rows of a memory-mapped file, `<dim>.f16`, plus `<dim>.keys` that
+    holds one key per line, the key of line i is the one of row i. Both files are only appended to, under a lock, so
+    several processes can share them. A row is written before its key, a writer that crashed in between leaves
+    rows without keys, they are truncated before the next rows are appended.
+    """
+
+    def __init__(self, cache_dir: str, dim: int):
+        self.dim = dim
+        self.data_path = os.path.join(cache_dir, f"{dim}.f16")
+        self.keys_path = os.path.join(cache_dir, f"{dim}.keys")
+        os.makedirs(cache_dir, exist_ok=True)
+        for path in [self.data_path, self.keys_path]:
+            open(path, "ab").close()
+
+        self._key2row: Dict[str, int] = {}
+        self._keys_offset = 0
+        self._data: Optional[np.memmap] = None
+        with self._lock():
+            self._align()
+
+    def _load_new_keys(self) -> None:
+        # only complete lines count, a key is written after its row
+        with open(self.keys_path, "rb") as f:
+            f.seek(self._keys_offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                self._key2row[line.decode("ascii").strip()] = len(self._key2row)
+                self._keys_offset += len(line)
+
+    def _row(self, row: int) -> Optional[np.ndarray]:
+        if self._data is None or row >= self._data.shape[0]:
+            num_rows = os.path.getsize(self.data_path) // (2 * self.dim)
+            if row >= num_rows:
+                return None
+            self._data = np.memmap(self.data_path, dtype=np.float16, mode="r", shape=(num_rows, self.dim))
+        return self._data[row]
+
+    @contextmanager
+    def _lock(self):
+        with open(self.keys_path, "ab") as keys_file:
+            if fcntl is not None:
+                fcntl.flock(keys_file, fcntl.LOCK_EX)
+            try:
+                yield keys_file
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(keys_file, fcntl.LOCK_UN)
+
+    def _align(self) -> None:
+        """Truncate both files to the rows that have a key and the keys that have a row, must hold the lock."""
+        self._load_new_keys()
+        if os.path.getsize(self.keys_path) > self._keys_offset:
+            # a key cut off in the middle
+            os.truncate(self.keys_path, self._keys_offset)
+        row_size = 2 * self.dim
+        num_keys = len(self._key2row)
+        num_rows = os.path.getsize(self.data_path) // row_size
+        if os.path.getsize(self.data_path) != num_keys * row_size and num_rows >= num_keys:
+            os.truncate(self.data_path, num_keys * row_size)
+            self._data = None
+        elif num_rows < num_keys:
+            with open(self.keys_path, "rb") as f:
+                keys_size = sum(len(f.readline()) for _ in range(num_rows))
+            os.truncate(self.keys_path, keys_size)
+            os.truncate(self.data_path, num_rows * row_size)
+            self._key2row = {}
+            self._keys_offset = 0
+            self._data = None
+            self._load_new_keys()
+
+    def get(self, key: str) -> Optional[List[float]]:
+        if key not in self._key2row:
+            self._load_new_keys()
+        row = self._key2row.get(key)
+        embedding = None if row is None else self._row(row)
+        return None if embedding is None else embedding.astype(np.float32).tolist()
+
+    def put(self, items: Dict[str, List[float]]) -> None:
+        with self._lock() as keys_file:
+            self._align()
+            items = {key: embedding for key, embedding in items.items() if key not in self._key2row}
+            if not items:
+                return
+            with open(self.data_path, "ab") as data_file:
+                data_file.write(np.asarray(list(items.values()), dtype=np.float16).tobytes())
+            keys_file.write("".join(f"{key}\n" for key in items).encode("ascii"))
+            keys_file.flush()
+
+
+class EmbeddingCache:
+    """
+    Embeddings keyed by a hash of the embedding model and the text, fronted by an in-memory LRU and optionally
+    stored on disk. Embeddings sharing a config in one process share one EmbeddingCache, get it by
+    `EmbeddingCache.get_cache`.
+    """
+
+    _caches: Dict[str, "EmbeddingCache"] = {}
+
+    def __init__(self, cache_dir: Optional[str], memory_size: int):
+        self.cache_dir = cache_dir
+        self.memory_size = memory_size
+
+        self._memory: OrderedDict = OrderedDict()
+        self._stores: Dict[int, _DiskStore] = {}
+
+        self.num_hits = 0
+        self.num_misses = 0
+
+    @classmethod
+    def get_cache(cls, config: EmbeddingCacheConfig) -> Optional["EmbeddingCache"]:
+        if config.mode == "off":
+            return None
+        cache_dir = os.path.abspath(config.cache_dir or DEFAULT_CACHE_DIR) if config.mode == "disk" else None
+        cache_id = f"{cache_dir}|{config.memory_size}"
+        if cache_id not in cls._caches:
+            cls._caches[cache_id] = cls(cache_dir, config.memory_size)
+        return cls._caches[cache_id]
+
+    @staticmethod
+    def make_key(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, embedding: List[float]) -> None:
+        if not self.memory_size:
+            return
+        self._memory[key] = embedding
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def _get_stores(self) -> List[_DiskStore]:
+        if self.cache_dir is None:
+            return []
+        # a store is opened for each dimension seen on disk, so embeddings stored by other processes are found
+        if os.path.isdir(self.cache_dir):
+            for file_name in os.listdir(self.cache_dir):
+                dim, ext = os.path.splitext(file_name)
+                if ext == ".f16" and dim.isdigit() and int(dim) not in self._stores:
+                    self._stores[int(dim)] = _DiskStore(self.cache_dir, int(dim))
+        return list(self._stores.values())
+
+    def lookup(self, keys: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        missing = []
+        for key in keys:
+            embedding = self._memory.get(key)
+            if embedding is not None:
+                self._memory.move_to_end(key)
+                found[key] = embedding
+            else:
+                missing.append(key)
+        if missing:
+            stores = self._get_stores()
+            for key in missing:
+                for store in stores:
+                    embedding = store.get(key)
+                    if embedding is not None:
+                        self._remember(key, embedding)
+                        found[key] = embedding
+                        break
+        num_hits = sum(key in found for key in keys)
+        self.num_hits += num_hits
+        self.num_misses += len(keys) - num_hits
+        EMBEDDING_CACHE_LOOKUPS.labels(result="hit").inc(num_hits)
+        EMBEDDING_CACHE_LOOKUPS.labels(result="miss").inc(len(keys) - num_hits)
+        return found
+
+    def store(self, items: Dict[str, List[float]]) -> None:
+        for key, embedding in items.items():
+            self._remember(key, embedding)
+        if self.cache_dir is None or not items:
+            return
+        dim2items = {}
+        for key, embedding in items.items():
+            dim2items.setdefault(len(embedding), {})[key] = embedding
+        for dim, dim_items in dim2items.items():
+            if dim not in self._stores:
+                self._stores[dim] = _DiskStore(self.cache_dir, dim)
+            self._stores[dim].put(dim_items)
+
+    def get_stats(self) -> dict:
+        num_lookups = self.num_hits + self.num_misses
+        return {
+            "hits": self.num_hits,
+            "misses": self.num_misses,
+            "hit_rate": round(self.num_hits / num_lookups, 4) if num_lookups else None,
+            "memory_entries": len(self._memory)
+        }
+
+
+class CachedEmbeddings(BaseRagasEmbeddings):
+    """
+    Ragas embeddings that look each text up in an EmbeddingCache first and only embed the missing ones, in one
+    call to the wrapped embeddings.
+    """
+
+    def __init__(self, embeddings: BaseRagasEmbeddings, cache: EmbeddingCache):
+        self.embeddings = embeddings
+        self.cache = cache
+        inner = getattr(embeddings, "embeddings", embeddings)
+        self.model = f"{type(inner).__name__}:{getattr(inner, 'model', None) or getattr(inner, 'model_name', '')}"
+        self.set_run_config(getattr(embeddings, "run_config", None) or RunConfig())
+
+    def set_run_config(self, run_config: RunConfig):
+        self.run_config = run_config
+        self.embeddings.set_run_config(run_config)
+
+    def _split(self, texts: List[str]):
+        keys = [self.cache.make_key(self.model, text) for text in texts]
+        found = self.cache.lookup(keys)
+        # each distinct missing text is embedded once
+        missing = list(dict.fromkeys(
+            (key, text) for key, text in zip(keys, texts) if key not in found
+        ))
+        return keys, found, missing
+
+    def _merge(self, keys, found, missing, embeddings: List[List[float]]) -> List[List[float]]:
+        new = {key: list(embedding) for (key, _), embedding in zip(missing, embeddings)}
+        self.cache.store(new)
+        return [found.get(key) or new[key] for key in keys]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, found, missing = self._split(texts)
+        embeddings = self.embeddings.embed_documents([text for _, text in missing]) if missing else []
+        return self._merge(keys, found, missing, embeddings)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, found, missing = self._split(texts)
+        embeddings = await self.embeddings.aembed_documents([text for _, text in missing]) if missing else []
+        return self._merge(keys, found, missing, embeddings)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+
+__all__ = [
+    "EmbeddingCacheConfig",
+    "EmbeddingCache",
+    "CachedEmbeddings"
+]
@@ -1,14 +1,23 @@
-from typing import Any, Dict, Literal, List, Optional, Union
+import asyncio
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Literal, List, Optional, Tuple, Union
+from uuid import UUID, uuid4
 
 from datasets import Dataset, Features, Value, Sequence
+from pydantic import Field, model_validator
 from ragas import evaluate
+from ragas.embeddings.base import embedding_factory
+from ragas.metrics.base import MetricWithEmbeddings
 
 from leaf_eval_tools.ragas_eval_worker import RagasEvalWorker, RagasEvalWorkerConfig
 from leaf_playground.core.workers import MetricEvaluatorConfig, MetricEvaluator
 from leaf_playground.core.workers.evaluator import _MetricName, CompareOutput, RecordOutput
+from leaf_playground.data.log_body import ActionLogBody
 from leaf_playground.data.media import Json, Text
 from leaf_playground.data.message import Message
 
+from ..embedding_cache import CachedEmbeddings, EmbeddingCache, EmbeddingCacheConfig
 from ..scene_definition import ExamineeAnswer, SCENE_DEFINITION
 
 from ragas.metrics import (
@@ -33,9 +42,106 @@ ragas_metrics_map = {
 
 ROLE_DEFINITION = SCENE_DEFINITION.get_role_definition("examinee")
 
+FEATURES = Features({
+    'question': Value('string'),
+    'answer': Value('string'),
+    'contexts': Sequence(Value('string')),
+    'ground_truths': Sequence(Value('string')),
+    'golden_answer': Value('string')
+})
+# a kwarg only batched evaluations pass to `_record`, their results are keyed by "<index in batch>|<metric name>"
+BATCH_KWARG = "ragas_batch"
+BATCH_KEY_SEP = "|"
+RESULT_POLL_SECONDS = 0.1
+LOG_FIELDS_NOT_IN_KWARGS = {
+    "log_type",
+    "response",
+    "references",
+    "ground_truth",
+    "eval_records",
+    "compare_records",
+    "human_eval_records",
+    "human_compare_records",
+}
+
+
+def _to_row(
+    response: Message,
+    references: Optional[List[Message]],
+    ground_truth: Optional[Union[Json, Text]]
+) -> Optional[dict]:
+    if not isinstance(response, ExamineeAnswer) or not isinstance(ground_truth, Json):
+        return None
+    data: dict = ground_truth.data
+    return {
+        'question': references[0].content.text,
+        'answer': response.content.data['answer'],
+        'contexts': response.content.data['contexts'],
+        'ground_truths': data.get('ground_truths', None),
+        'golden_answer': data.get('golden_answer', None)
+        # Actually, it’s not used here. The original answer from ragas is the evaluated answer,
+        # and it is placed here for future reference when displaying in the log.
+    }
+
+
+def _score_rows(rows: List[Optional[dict]], eval_tool: RagasEvalWorker) -> List[Dict[_MetricName, RecordOutput]]:
+    """Score all rows in one ragas run, rows that are None get no record."""
+    results = [{} for _ in rows]
+    indices = [i for i, row in enumerate(rows) if row is not None]
+    if not indices:
+        return results
+
+    dataset = Dataset.from_list([rows[i] for i in indices], features=FEATURES)
+    try:
+        output = eval_tool(dataset)
+        # per-row scores, the Result itself only holds each metric's mean over all rows
+        scores = output.scores
+    except Exception as e:
+        print(f"Ragas evaluate error: {e}")
+        return results
+
+    for i, row_scores in zip(indices, scores):
+        for metric in output.keys():
+            results[i][f"examinee.answer_question.{metric}"] = RecordOutput(
+                record_value=round(row_scores[metric], 4),
+                misc=rows[i]
+            )
+    return results
+
 
 class RagasEvaluatorConfig(MetricEvaluatorConfig):
-    pass
+    max_queued_evaluations: int = Field(
+        default=256,
+        ge=1,
+        description="how many answers can be sent to the ragas worker processes (max_concurrency of them) before "
+                    "more answers wait for one to be scored"
+    )
+    batch_size: int = Field(
+        default=8,
+        ge=1,
+        description="how many answers are scored in one ragas run, answers waiting at the same time are batched, "
+                    "the scene evaluates at least batch_size answers at the same time so that a batch can fill up, "
+                    "1 turns batching off"
+    )
+    batch_wait_seconds: float = Field(
+        default=0.5,
+        ge=0,
+        description="how long an answer waits for others to fill its batch before the batch is scored"
+    )
+    embedding_cache_config: EmbeddingCacheConfig = Field(
+        default_factory=EmbeddingCacheConfig,
+        description="embeddings of texts seen before (golden answers, questions, ...) are reused instead of embedded "
+                    "again for each examinee"
+    )
+
+    @model_validator(mode="after")
+    def _check_batch_size(self) -> "RagasEvaluatorConfig":
+        if self.batch_size > self.max_queued_evaluations:
+            raise ValueError(
+                f"batch_size ({self.batch_size}) can't be larger than max_queued_evaluations "
+                f"({self.max_queued_evaluations}), a batch would never fill up"
+            )
+        return self
 
 
 class RagasEvaluator(
@@ -46,16 +152,130 @@ class RagasEvaluator(
     config_cls = RagasEvaluatorConfig
     config: config_cls
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pending: List[Tuple[ActionLogBody, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        # queue and result cache are Manager proxies whose every call is a blocking round trip to the manager
+        # process, so they are only called from this thread, never from the scene's event loop
+        self._ipc_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ragas_evaluator_ipc")
+        self._waiting: Dict[UUID, asyncio.Future] = {}
+        self._poller: Optional[asyncio.Task] = None
+        self._queue_slots: Optional[asyncio.Semaphore] = None
+
+    async def _wait_result(self, log: ActionLogBody, is_compare: bool = False):
+        if self._queue_slots is None:
+            self._queue_slots = asyncio.Semaphore(self.config.max_queued_evaluations)
+        async with self._queue_slots:
+            if is_compare or self.config.batch_size <= 1:
+                output = await self._submit([log], is_compare=is_compare)
+                return {k: (CompareOutput if is_compare else RecordOutput)(**v) for k, v in output.items()}
+
+            future = asyncio.get_running_loop().create_future()
+            self._pending.append((log, future))
+            if len(self._pending) >= self.config.batch_size:
+                self._flush_pending()
+            elif self._flush_handle is None:
+                self._flush_handle = asyncio.get_running_loop().call_later(
+                    self.config.batch_wait_seconds, self._flush_pending
+                )
+            return await future
+
+    def _flush_pending(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.ensure_future(self._wait_batch_result(batch))
+
+    async def _wait_batch_result(self, batch: List[Tuple[ActionLogBody, asyncio.Future]]):
+        """Send the batch to the evaluator processes as one queue item, then fan its results out to each log."""
+        try:
+            output = await self._submit([log for log, _ in batch], batched=True)
+            results = [{} for _ in batch]
+            for key, record_output in output.items():
+                index, metric_name = key.split(BATCH_KEY_SEP, 1)
+                results[int(index)][metric_name] = RecordOutput(**record_output)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def _put(self, logs: List[ActionLogBody], is_compare: bool, batched: bool, id_: UUID):
+        message_pool = self.logger.message_pool
+        responses = [message_pool.get_message_by_id(log.response) for log in logs]
+        references = [[message_pool.get_message_by_id(ref) for ref in (log.references or [])] or None for log in logs]
+        ground_truths = [log.ground_truth for log in logs]
+        kwargs = [log.model_dump(mode="json", exclude=LOG_FIELDS_NOT_IN_KWARGS) for log in logs]
+        if batched:
+            item = (responses, references, ground_truths, {BATCH_KWARG: kwargs})
+        else:
+            item = (responses[0], references[0], ground_truths[0], kwargs[0])
+        self.queue.put_nowait((*[pickle.dumps(each) for each in item], is_compare, id_))
+
+    def _pop_finished(self, ids: List[UUID]) -> Dict[UUID, dict]:
+        finished = set(self.result_cache.keys())
+        return {id_: self.result_cache.pop(id_) for id_ in ids if id_ in finished}
+
+    async def _submit(self, logs: List[ActionLogBody], is_compare: bool = False, batched: bool = False) -> dict:
+        loop = asyncio.get_running_loop()
+        id_ = uuid4()
+        future = loop.create_future()
+        self._waiting[id_] = future
+        try:
+            await loop.run_in_executor(self._ipc_executor, self._put, logs, is_compare, batched, id_)
+        except Exception:
+            self._waiting.pop(id_, None)
+            raise
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.ensure_future(self._poll_results())
+        return await future
+
+    async def _poll_results(self):
+        """One poller for all waiting items, each poll is a single round trip instead of one per item."""
+        loop = asyncio.get_running_loop()
+        while self._waiting:
+            await asyncio.sleep(RESULT_POLL_SECONDS)
+            try:
+                finished = await loop.run_in_executor(self._ipc_executor, self._pop_finished, list(self._waiting))
+            except Exception as e:
+                waiting, self._waiting = self._waiting, {}
+                for future in waiting.values():
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            for id_, output in finished.items():
+                future = self._waiting.pop(id_)
+                if not future.done():
+                    future.set_result(output)
+
+    def terminate(self):
+        super().terminate()
+        self._ipc_executor.shutdown(wait=False)
+
     @staticmethod
     def _init_eval_tools(
         config: MetricEvaluatorConfig,
         record_metrics: List[_MetricName],
         compare_metrics: List[_MetricName]
     ) -> List[RagasEvalWorker]:
-        eval_tool = RagasEvalWorker(
-            config=RagasEvalWorkerConfig(),
-            activated_metrics=[ragas_metrics_map[metric_name.split('.')[-1]] for metric_name in record_metrics]
-        )
+        activated_metrics = [ragas_metrics_map[metric_name.split('.')[-1]] for metric_name in record_metrics]
+        embedding_cache = EmbeddingCache.get_cache(config.embedding_cache_config)
+        embedding_metrics = [
+            metric for metric in activated_metrics
+            if isinstance(metric, MetricWithEmbeddings) and metric.embeddings is None
+        ]
+        if embedding_cache is not None and embedding_metrics:
+            # the same embeddings ragas would set by default, only cached, ragas keeps embeddings already set
+            embeddings = CachedEmbeddings(embedding_factory(), embedding_cache)
+            for metric in embedding_metrics:
+                metric.embeddings = embeddings
+        eval_tool = RagasEvalWorker(config=RagasEvalWorkerConfig(), activated_metrics=activated_metrics)
         return [eval_tool]
 
     @staticmethod
@@ -66,56 +286,28 @@ class RagasEvaluator(
         eval_tools: List[RagasEvalWorker],
         **kwargs
     ) -> Dict[_MetricName, RecordOutput]:
-        result = {}
-        if isinstance(response, ExamineeAnswer) and ground_truth:
-
-            if isinstance(ground_truth, Json):
-                data: dict = ground_truth.data
-            else:
-                return result
-
-            question = references[0].content.text
-            ground_truths = data.get('ground_truths', None)
-            golden_answer = data.get('golden_answer', None)
-            agent_answer = response.content.data['answer']
-            contexts = response.content.data['contexts']
-
-            misc = {
-                'question': question,
-                'answer': agent_answer,
-                'contexts': contexts,
-                'ground_truths': ground_truths,
-                'golden_answer': golden_answer
-                # Actually, it’s not used here. The original answer from ragas is the evaluated answer,
-                # and it is placed here for future reference when displaying in the log.
+        if BATCH_KWARG in kwargs:
+            # response, references and ground_truth are lists, one item for each answer in the batch
+            rows = [_to_row(*item) for item in zip(response, references, ground_truth)]
+            return {
+                f"{index}{BATCH_KEY_SEP}{metric_name}": output
+                for index, result in enumerate(_score_rows(rows, eval_tools[0]))
+                for metric_name, output in result.items()
             }
+        return _score_rows([_to_row(response, references, ground_truth)], eval_tools[0])[0]
 
-            features = Features({
-                'question': Value('string'),
-                'answer': Value('string'),
-                'contexts': Sequence(Value('string')),
-                'ground_truths': Sequence(Value('string')),
-                'golden_answer': Value('string')
-            })
-
-            def gen():
-                yield misc
-
-            dataset = Dataset.from_generator(gen, features=features)
-
-            try:
-                output = eval_tools[0](dataset)
-            except Exception as e:
-                print(f"Ragas evaluate error: {e}")
-                output = {}
-
-            for metric, value in output.items():
-                result[f"examinee.answer_question.{metric}"] = RecordOutput(
-                    record_value=round(value, 4),
-                    misc=misc
-                )
-
-        return result
+    @classmethod
+    def record_batch(
+        cls,
+        config: RagasEvaluatorConfig,
+        record_metrics: List[_MetricName],
+        responses: List[Message],
+        references: List[Optional[List[Message]]],
+        ground_truths: List[Optional[Union[Json, Text]]]
+    ) -> List[Dict[_MetricName, RecordOutput]]:
+        """`_record` of many logs in one go, used by rescore, all answers are scored in one ragas run."""
+        eval_tool = cls._init_eval_tools(config, record_metrics, [])[0]
+        return _score_rows([_to_row(*item) for item in zip(responses, references, ground_truths)], eval_tool)
 
     @staticmethod
     async def _compare(
@@ -0,0 +1,229 @@
+import asyncio
+import heapq
+import itertools
+import json
+import random
+import time
+import weakref
+from typing import Any, Dict, List, Optional, Tuple
+
+import openai
+from pydantic import Field
+
+from leaf_playground._config import _Config
+
+from .instrumentation import RATE_LIMIT_RETRIES, RATE_LIMIT_WAIT_SECONDS
+
+
+class RateLimitConfig(_Config):
+    requests_per_minute: Optional[int] = Field(
+        default=None,
+        ge=1,
+        description="requests per minute allowed by the deployment, unlimited when not set"
+    )
+    tokens_per_minute: Optional[int] = Field(
+        default=None,
+        ge=1,
+        description="tokens per minute allowed by the deployment, unlimited when not set"
+    )
+    priority: int = Field(
+        default=0,
+        ge=0,
+        description="when the quota runs short, requests with a lower value are sent first, only among requests "
+                    "sent from the same process"
+    )
+    max_retries: int = Field(
+        default=3,
+        ge=0,
+        description="how many times a request is retried on rate limit, server and connection errors"
+    )
+    max_backoff_seconds: float = Field(
+        default=60,
+        gt=0,
+        description="upper bound of the wait between two retries"
+    )
+
+
+class RateLimiter:
+    """
+    RPM and TPM token buckets of one deployment, shared by all agents in the process that send requests to it, get
+    it by `RateLimiter.get_limiter`. Waiting requests are served by priority, then in arrival order.
+
+    Limits and priorities are per process, evaluators run in processes of their own and so throttle their requests
+    by limiters of their own, give agents and evaluators each their share of the deployment's quota.
+    """
+
+    _limiters: Dict[str, "RateLimiter"] = {}
+
+    def __init__(self, deployment: str, requests_per_minute: Optional[int], tokens_per_minute: Optional[int]):
+        self.deployment = deployment
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+
+        self._requests = float(requests_per_minute or 0)
+        self._tokens = float(tokens_per_minute or 0)
+        self._refilled_at = time.monotonic()
+        # set when the server answers 429, no request is sent before that
+        self._paused_until = 0.0
+        self._waiters: List[Tuple[int, int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+        self.num_requests = 0
+        self.num_retries = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    @classmethod
+    def get_limiter(cls, deployment: str, config: RateLimitConfig) -> "RateLimiter":
+        # agents sharing a deployment share one limiter, the limits of the first of them are used
+        if deployment not in cls._limiters:
+            cls._limiters[deployment] = cls(deployment, config.requests_per_minute, config.tokens_per_minute)
+        return cls._limiters[deployment]
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._refilled_at
+        self._refilled_at = now
+        if self.requests_per_minute:
+            self._requests = min(
+                self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60
+            )
+        if self.tokens_per_minute:
+            self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
+
+    def _seconds_until_available(self, num_tokens: int) -> float:
+        delay = max(0.0, self._paused_until - time.monotonic())
+        if self.requests_per_minute and self._requests < 1:
+            delay = max(delay, (1 - self._requests) * 60 / self.requests_per_minute)
+        if self.tokens_per_minute and self._tokens < num_tokens:
+            delay = max(delay, (num_tokens - self._tokens) * 60 / self.tokens_per_minute)
+        return delay
+
+    def _schedule(self) -> None:
+        self._timer = None
+        self._refill()
+        while self._waiters:
+            _, _, num_tokens, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            delay = self._seconds_until_available(num_tokens)
+            if delay > 0:
+                self._timer = asyncio.get_running_loop().call_later(delay, self._schedule)
+                return
+            heapq.heappop(self._waiters)
+            if self.requests_per_minute:
+                self._requests -= 1
+            if self.tokens_per_minute:
+                self._tokens -= num_tokens
+            future.set_result(None)
+
+    def _reschedule(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+        self._schedule()
+
+    async def acquire(self, num_tokens: int, priority: int = 0) -> None:
+        if self.tokens_per_minute:
+            # a request larger than the whole bucket is sent once the bucket is full
+            num_tokens = min(num_tokens, self.tokens_per_minute)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), num_tokens, future))
+        start = time.monotonic()
+        self._reschedule()
+        await future
+        waited = time.monotonic() - start
+        self.num_requests += 1
+        self.wait_seconds += waited
+        self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        RATE_LIMIT_WAIT_SECONDS.labels(deployment=self.deployment).observe(waited)
+
+    def adjust_tokens(self, num_tokens: int) -> None:
+        """Charge (or refund when negative) the difference between a request's actual and estimated tokens."""
+        if self.tokens_per_minute and num_tokens:
+            self._tokens = min(self.tokens_per_minute, self._tokens - num_tokens)
+            self._reschedule()
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._reschedule()
+
+    def get_stats(self) -> dict:
+        return {
+            "requests": self.num_requests,
+            "retries": self.num_retries,
+            "waiting_requests": len(self._waiters),
+            "avg_wait_seconds": round(self.wait_seconds / self.num_requests, 4) if self.num_requests else None,
+            "max_wait_seconds": round(self.max_wait_seconds, 4)
+        }
+
+
+def _estimate_tokens(request: Dict[str, Any]) -> int:
+    # about 4 characters per token, plus the tokens the completion may use
+    prompt_chars = len(json.dumps(request.get("messages", []), ensure_ascii=False, default=str))
+    return prompt_chars // 4 + (request.get("max_tokens") or 0)
+
+
+def _get_retry_after(e: openai.APIStatusError) -> Optional[float]:
+    headers = e.response.headers
+    for header, scale in [("retry-after-ms", 0.001), ("retry-after", 1)]:
+        try:
+            return float(headers[header]) * scale
+        except (KeyError, TypeError, ValueError):
+            continue
+    return None
+
+
+# the SDK's own retries would be sent outside of the limiter, so requests go through a copy of the client without them
+_clients_without_retries: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+def _without_retries(client):
+    if getattr(client, "max_retries", 0) == 0:
+        return client
+    if client not in _clients_without_retries:
+        _clients_without_retries[client] = client.with_options(max_retries=0)
+    return _clients_without_retries[client]
+
+
+async def call_with_rate_limit(client, config: RateLimitConfig, request: Dict[str, Any]) -> Any:
+    """
+    Send `request` by `client.chat.completions.create` once the deployment's quota allows it, retrying with jittered
+    exponential backoff (or the server's Retry-After) on rate limit, server and connection errors.
+    """
+    limiter = RateLimiter.get_limiter(f"{client.base_url}|{request.get('model')}", config)
+    client = _without_retries(client)
+    num_tokens = _estimate_tokens(request)
+    attempt = 0
+    while True:
+        await limiter.acquire(num_tokens, config.priority)
+        try:
+            resp = await client.chat.completions.create(**request)
+        except (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError) as e:
+            if attempt >= config.max_retries:
+                raise
+            retry_after = _get_retry_after(e) if isinstance(e, openai.APIStatusError) else None
+            backoff = min(config.max_backoff_seconds, 2 ** attempt)
+            delay = retry_after if retry_after is not None else random.uniform(0, backoff)
+            if isinstance(e, openai.RateLimitError):
+                # the quota is shared, so hold back every request to the deployment, not only this one
+                limiter.pause(delay)
+                RATE_LIMIT_RETRIES.labels(deployment=limiter.deployment, reason="rate_limit").inc()
+            else:
+                RATE_LIMIT_RETRIES.labels(deployment=limiter.deployment, reason="server_error").inc()
+            limiter.num_retries += 1
+            attempt += 1
+            await asyncio.sleep(delay)
+            continue
+        usage = getattr(resp, "usage", None)
+        if usage is not None and getattr(usage, "total_tokens", None):
+            limiter.adjust_tokens(usage.total_tokens - num_tokens)
+        return resp
+
+
+__all__ = [
+    "RateLimitConfig",
+    "RateLimiter",
+    "call_with_rate_limit"
+]
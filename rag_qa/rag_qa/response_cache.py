@@ -0,0 +1,168 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Literal, Optional
+
+from pydantic import Field
+
+from leaf_playground._config import _Config
+
+from .instrumentation import RESPONSE_CACHE_LOOKUPS
+from .rate_limiter import RateLimitConfig, call_with_rate_limit
+
+DEFAULT_CACHE_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache", "llm_responses.sqlite3"
+)
+
+
+class ResponseCacheConfig(_Config):
+    mode: Literal["read_write", "read_only", "off"] = Field(
+        default="off",
+        description="read_write looks up and stores responses, read_only only looks up, off calls the API every time"
+    )
+    cache_path: Optional[str] = Field(
+        default=None,
+        description="path of the SQLite file responses are stored in, defaults to .cache/llm_responses.sqlite3 "
+                    "under the project directory"
+    )
+    memory_size: int = Field(
+        default=1024,
+        ge=0,
+        description="how many responses are also kept in memory, least recently used ones are dropped first"
+    )
+
+
+class ResponseCache:
+    """
+    Chat completion responses keyed by a hash of the full request (model, messages, temperature, max_tokens and
+    every other parameter), stored in SQLite and fronted by an in-memory LRU. Agents that share a cache file share
+    one ResponseCache, get it by `ResponseCache.get_cache`.
+    """
+
+    _caches: Dict[str, "ResponseCache"] = {}
+
+    def __init__(self, cache_path: str, memory_size: int):
+        self.cache_path = cache_path
+        self.memory_size = memory_size
+
+        self._memory: OrderedDict = OrderedDict()
+        # sqlite3 connections are used from the thread that created them, so all I/O runs on one thread
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="response_cache")
+        self._conn: Optional[sqlite3.Connection] = None
+
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_writes = 0
+
+    @classmethod
+    def get_cache(cls, config: ResponseCacheConfig) -> Optional["ResponseCache"]:
+        if config.mode == "off":
+            return None
+        cache_path = os.path.abspath(config.cache_path or DEFAULT_CACHE_PATH)
+        if cache_path not in cls._caches:
+            cls._caches[cache_path] = cls(cache_path, config.memory_size)
+        return cls._caches[cache_path]
+
+    @staticmethod
+    def make_key(request: Dict[str, Any]) -> str:
+        return hashlib.sha256(
+            json.dumps(request, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+        ).hexdigest()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            self._conn = sqlite3.connect(self.cache_path)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL)")
+            self._conn.commit()
+        return self._conn
+
+    def _read(self, key: str) -> Optional[str]:
+        row = self._connect().execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _write(self, key: str, response: str) -> None:
+        conn = self._connect()
+        conn.execute("INSERT OR REPLACE INTO responses (key, response) VALUES (?, ?)", (key, response))
+        conn.commit()
+
+    def _remember(self, key: str, response: str) -> None:
+        if not self.memory_size:
+            return
+        self._memory[key] = response
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    async def lookup(self, key: str) -> Optional[str]:
+        response = self._memory.get(key)
+        if response is not None:
+            self._memory.move_to_end(key)
+        else:
+            response = await asyncio.get_running_loop().run_in_executor(self._executor, self._read, key)
+            if response is not None:
+                self._remember(key, response)
+        if response is None:
+            self.num_misses += 1
+            RESPONSE_CACHE_LOOKUPS.labels(result="miss").inc()
+        else:
+            self.num_hits += 1
+            RESPONSE_CACHE_LOOKUPS.labels(result="hit").inc()
+        return response
+
+    async def store(self, key: str, response: str) -> None:
+        self._remember(key, response)
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._write, key, response)
+        self.num_writes += 1
+
+    def get_stats(self) -> dict:
+        num_lookups = self.num_hits + self.num_misses
+        return {
+            "hits": self.num_hits,
+            "misses": self.num_misses,
+            "writes": self.num_writes,
+            "hit_rate": round(self.num_hits / num_lookups, 4) if num_lookups else None,
+            "memory_entries": len(self._memory)
+        }
+
+
+async def create_chat_completion(
+    client,
+    config: ResponseCacheConfig,
+    rate_limit_config: Optional[RateLimitConfig] = None,
+    **request
+) -> Optional[str]:
+    """
+    Call `client.chat.completions.create(**request)` and return the content of its first choice, looking up and
+    storing the content in the response cache according to `config.mode`. Requests missing the cache are throttled
+    and retried according to `rate_limit_config` when given, errors left after retrying are raised as is.
+    """
+    cache = ResponseCache.get_cache(config)
+    key = None
+    if cache is not None:
+        key = cache.make_key(request)
+        content = await cache.lookup(key)
+        if content is not None:
+            return content
+
+    if rate_limit_config is not None:
+        resp = await call_with_rate_limit(client, rate_limit_config, request)
+    else:
+        resp = await client.chat.completions.create(**request)
+    content = resp.choices[0].message.content
+
+    if cache is not None and config.mode == "read_write" and content is not None:
+        await cache.store(key, content)
+    return content
+
+
+__all__ = [
+    "ResponseCacheConfig",
+    "ResponseCache",
+    "create_chat_completion"
+]
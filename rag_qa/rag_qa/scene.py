@@ -1,8 +1,10 @@
 import asyncio
+import traceback
 from typing import List, Optional
 
 from pydantic import Field
 
+from leaf_playground._config import _Config
 from leaf_playground.core.workers import Logger
 from leaf_playground.core.scene import Scene
 from leaf_playground.core.scene_definition import SceneConfig
@@ -12,6 +14,7 @@ from leaf_playground.data.media import Text, Json
 from .agents.examiner import Examiner
 from .agents.base_examinee import AIBaseExaminee
 from .dataset_utils import DatasetConfig
+from .instrumentation import EVALUATION_FAILURES, SAMPLES_FINISHED, track_agent_action
 from .scene_definition import ExamineeAnswer, ExaminerQuestion, MessageType, SCENE_DEFINITION
 
 
@@ -19,10 +22,35 @@ class RagSceneLogBody(ActionLogBody):
     ground_truth: Optional[Json] = Field(default=None)
 
 
+class SchedulerConfig(_Config):
+    max_questions_in_flight: int = Field(
+        default=1,
+        ge=1,
+        description="how many questions can be sent before all examinees answered the earliest one"
+    )
+    max_concurrency_per_examinee: int = Field(
+        default=1,
+        ge=1,
+        description="how many questions an examinee can answer at the same time"
+    )
+    max_concurrent_evaluations: int = Field(
+        default=4,
+        ge=1,
+        description="how many answers can be evaluated at the same time, raised to the largest batch_size of the "
+                    "evaluators so that their batches can fill up"
+    )
+    evaluation_queue_size: int = Field(
+        default=64,
+        ge=1,
+        description="how many answers can wait for evaluation before answering is paused"
+    )
+
+
 RagSceneConfig = SceneConfig.create_config_model(
     SCENE_DEFINITION,
     additional_config_fields={
         "dataset_config": (DatasetConfig, Field(default=...)),
+        "scheduler_config": (SchedulerConfig, Field(default_factory=SchedulerConfig)),
         "debug_mode": (bool, Field(default=False, exclude=True))
     }
 )
@@ -39,9 +67,25 @@ class RagScene(Scene, scene_definition=SCENE_DEFINITION, log_body_class=RagScene
         self.examinees: List[AIBaseExaminee] = self.agents["examinee"]
 
     async def _run(self):
-        async def examinee_answer(examinee: AIBaseExaminee, q: ExaminerQuestion) -> None:
+        scheduler_config: SchedulerConfig = self.config.scheduler_config
+        # released once a question's logs are written, bounds how far the examiner can get ahead of examinees
+        window = asyncio.Semaphore(scheduler_config.max_questions_in_flight)
+        examinee_semaphores = {
+            examinee.id: asyncio.Semaphore(scheduler_config.max_concurrency_per_examinee)
+            for examinee in self.examinees
+        }
+        # questions in the order they were sent, with the task answering them
+        answering = asyncio.Queue()
+        # answers waiting for evaluation, bounded so that slow evaluation pauses answering instead of piling up
+        evaluating = asyncio.Queue(maxsize=scheduler_config.evaluation_queue_size)
+
+        async def examinee_answer(examinee: AIBaseExaminee, q: ExaminerQuestion) -> ExamineeAnswer:
             try:
-                answer: ExamineeAnswer = await examinee.answer_question(question=q, examiner=self.examiner.profile)
+                async with examinee_semaphores[examinee.id]:
+                    with track_agent_action(examinee.name, "answer_question"):
+                        answer: ExamineeAnswer = await examinee.answer_question(
+                            question=q, examiner=self.examiner.profile
+                        )
             except:
                 if self.config.debug_mode:
                     raise
@@ -51,40 +95,100 @@ class RagScene(Scene, scene_definition=SCENE_DEFINITION, log_body_class=RagScene
                     content=Json(data={"answer": "", "contexts": []}),
                     question_id=q.question_id
                 )
-            self.message_pool.put_message(answer)
-            ground_truth = self.examiner.get_golden_answer(q.question_id)
-            log = self.log_body_class(
-                references=[q.id],
-                response=answer.id,
-                ground_truth=Json(data=ground_truth) if ground_truth else None,
-                log_msg=f"examinee [{examinee.name}] answered question [{q.question_id}]",
-                action_belonged_chain=examinee.role_definition.get_action_definition("answer_question").belonged_chain
-            )
-            self.logger.add_log(log)
-            self.notify_evaluators_record(log)
+            return answer
 
-        self.examiner.prepare_questions(self.config.dataset_config)
-        while not self.examiner.check_examine_finish():
-            question: ExaminerQuestion = self.examiner.send_question(
-                receivers=[examinee.profile for examinee in self.examinees]
-            )
-            self.message_pool.put_message(question)
+        async def write_logs(q: ExaminerQuestion, answers: List[ExamineeAnswer]) -> None:
             self.logger.add_log(
                 self.log_body_class(
                     references=None,
-                    response=question.id,
+                    response=q.id,
                     ground_truth=None,
-                    log_msg=f"examiner sent question [{question.question_id}] to all examinees",
+                    log_msg=f"examiner sent question [{q.question_id}] to all examinees",
                     action_belonged_chain=None
                 )
             )
+            ground_truth = self.examiner.get_ground_truth(q.question_id)
+            for examinee, answer in zip(self.examinees, answers):
+                self.message_pool.put_message(answer)
+                log = self.log_body_class(
+                    references=[q.id],
+                    response=answer.id,
+                    ground_truth=ground_truth,
+                    log_msg=f"examinee [{examinee.name}] answered question [{q.question_id}]",
+                    action_belonged_chain=examinee.role_definition.get_action_definition(
+                        "answer_question"
+                    ).belonged_chain
+                )
+                self.logger.add_log(log)
+                await evaluating.put(log)
+
+        async def write_logs_in_order() -> None:
+            # questions may be answered out of order, logs are still written in the order questions were sent
+            while True:
+                item = await answering.get()
+                if item is None:
+                    return
+                q, answer_task = item
+                await write_logs(q, await answer_task)
+                SAMPLES_FINISHED.labels(scene=self.__class__.__name__).inc()
+                window.release()
+
+        async def evaluate() -> None:
+            while True:
+                log = await evaluating.get()
+                try:
+                    results = await asyncio.gather(
+                        *[evaluator.record(log) for evaluator in self.evaluators], return_exceptions=True
+                    )
+                    for evaluator, result in zip(self.evaluators, results):
+                        if isinstance(result, Exception):
+                            EVALUATION_FAILURES.labels(
+                                scene=self.__class__.__name__, evaluator=evaluator.__class__.__name__
+                            ).inc()
+                            traceback.print_exception(type(result), result, result.__traceback__)
+                        elif isinstance(result, BaseException):
+                            raise result
+                finally:
+                    evaluating.task_done()
 
-            await asyncio.gather(
-                *[examinee_answer(examinee, question) for examinee in self.examinees]
-            )
+        self.examiner.prepare_questions(self.config.dataset_config)
+        writer_task = asyncio.ensure_future(write_logs_in_order())
+        # wake up the loop below if the writer stops early
+        writer_task.add_done_callback(lambda _: window.release())
+        # an evaluator that batches answers only gets as many at once as there are evaluate tasks
+        num_evaluate_tasks = max(
+            [scheduler_config.max_concurrent_evaluations]
+            + [getattr(evaluator.config, "batch_size", 1) for evaluator in self.evaluators]
+        )
+        evaluate_tasks = [asyncio.ensure_future(evaluate()) for _ in range(num_evaluate_tasks)]
+        answer_tasks = set()
+        try:
+            while not self.examiner.check_examine_finish():
+                await window.acquire()
+                if writer_task.done():
+                    break
+                question: ExaminerQuestion = self.examiner.send_question(
+                    receivers=[examinee.profile for examinee in self.examinees]
+                )
+                self.message_pool.put_message(question)
+                answer_task = asyncio.ensure_future(
+                    asyncio.gather(*[examinee_answer(examinee, question) for examinee in self.examinees])
+                )
+                answer_tasks.add(answer_task)
+                answer_task.add_done_callback(answer_tasks.discard)
+                answering.put_nowait((question, answer_task))
+            answering.put_nowait(None)
+            await writer_task
+            # evaluators are told to stop once the scene finished, so every answer must be handed to them first
+            await evaluating.join()
+        finally:
+            writer_task.cancel()
+            for task in evaluate_tasks + list(answer_tasks):
+                task.cancel()
 
 
 __all__ = [
+    "SchedulerConfig",
     "RagSceneConfig",
     "RagScene"
 ]
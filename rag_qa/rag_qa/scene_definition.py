@@ -8,7 +8,10 @@ from leaf_playground.core.scene_definition.definitions.metric import _RecordData
 from leaf_playground.data.message import TextMessage, JsonMessage
 from leaf_playground.data.profile import Profile
 
+from .aggregation import MeanAggregator, incremental_aggregator
 
+
+@incremental_aggregator(MeanAggregator)
 def avg_fn(records: List[_RecordData]) -> AggregationMethodOutput:
     avg = round(sum(record.value for record in records) / len(records), 4)
     return AggregationMethodOutput(value=avg)
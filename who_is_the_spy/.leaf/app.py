@@ -1,27 +1,37 @@
 import asyncio
+import bisect
 import json
 import os
+import random
+import re
 import signal
+import time
 import traceback
+import zlib
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Optional
+from functools import wraps
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 
 import aiohttp
-import requests
 import sys
 from argparse import ArgumentParser
 from contextlib import asynccontextmanager
 
 from fastapi import status, FastAPI, Depends, HTTPException, WebSocket
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from leaf_playground._type import Singleton
-from leaf_playground.core.workers import Logger, LogHandler
+from leaf_playground.core.workers import Logger, LogHandler, MetricEvaluator, MetricReporter
 from leaf_playground.core.scene_agent import HumanConnection
 from leaf_playground.core.scene_engine import SceneEngine, SceneEngineState
 from leaf_playground.data.log_body import LogBody, ActionLogBody
-from leaf_playground.data.message import MessagePool
+from leaf_playground.data.message import Message as LEAFMessage, MessagePool
+from leaf_playground.utils.import_util import dynamically_import_fn
 from leaf_playground_cli.server.task import *
 from leaf_playground_cli.utils.debug_utils import maybe_set_debugger, IDEType, DebuggerConfig
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
 
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -38,6 +48,19 @@ parser.add_argument("--debug_ide", type=str, choices=["pycharm", "vscode"])
 parser.add_argument("--debugger_server_host", type=str, default="localhost")
 parser.add_argument("--debugger_server_port", type=int, default=3457)
 parser.add_argument("--debugger_server_port_evaluator", type=int, default=3458)
+parser.add_argument("--db_write_batch_size", type=int, default=64)
+parser.add_argument("--db_write_batch_interval", type=float, default=0.05)
+parser.add_argument("--db_write_concurrency", type=int, default=4)
+parser.add_argument("--db_update_coalesce_window", type=float, default=0.2)
+parser.add_argument("--db_write_queue_size", type=int, default=10000)
+parser.add_argument("--db_message_dedup_window", type=int, default=100000)
+parser.add_argument("--db_spool_dir", type=str, default=None)
+parser.add_argument("--db_spool_segment_size", type=int, default=64 * 1024 * 1024)
+parser.add_argument("--db_spool_max_backoff", type=float, default=60)
+parser.add_argument("--db_spool_drain_timeout", type=float, default=60)
+parser.add_argument("--http_timeout", type=float, default=600)
+parser.add_argument("--http_max_retries", type=int, default=3)
+parser.add_argument("--results_content_encoding", type=str, choices=["gzip", "zstd", "identity"], default="identity")
 args = parser.parse_args()
 
 
@@ -54,68 +77,484 @@ if args.debug:
     os.environ["EVALUATOR_DEBUGGER_SERVER_PORT"] = str(args.debugger_server_port_evaluator)
 
 
-def save_task_results_to_db(self, save_dir=None):
-    scene_config = self.get_scene_config(mode="dict")
-    evaluator_configs = self.get_evaluator_configs(mode="dict")
+class ServerClient(Singleton):
+    def __init__(self):
+        self._http_session = aiohttp.ClientSession(
+            base_url=args.server_url,
+            timeout=aiohttp.ClientTimeout(total=args.http_timeout)
+        )
+
+    async def request(self, method: str, url: str, **kwargs) -> Tuple[int, str]:
+        """
+        Send a request to the server, connection errors, timeouts and 5xx responses are retried with backoff.
+
+        POST isn't idempotent, a POST that timed out or got a 5xx may have been committed, so it's only retried when
+        the connection couldn't be established, other failures are left to the caller.
+
+        `data` can also be a callable that creates the body, it's called once per attempt so that streamed
+        bodies can be retried.
+        """
+        idempotent = method.lower() != "post"
+        for attempt in range(args.http_max_retries + 1):
+            is_last_attempt = attempt == args.http_max_retries
+            request_kwargs = {k: v() if k == "data" and callable(v) else v for k, v in kwargs.items()}
+            try:
+                async with self._http_session.request(method, url, **request_kwargs) as resp:
+                    if resp.status < 500 or is_last_attempt or not idempotent:
+                        return resp.status, await resp.text()
+            except aiohttp.ClientConnectorError:
+                # the request never reached the server
+                if is_last_attempt:
+                    raise
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if is_last_attempt or not idempotent:
+                    raise
+            await asyncio.sleep(min(2 ** attempt, 30) * random.uniform(0.5, 1.0))
+
+
+_task_status_lock = asyncio.Lock()
+_task_results_lock = asyncio.Lock()
+# content encodings the server rejected, results are uploaded uncompressed after that
+_unsupported_content_encodings = set()
+
+
+def _dumps(obj: Any) -> str:
+    return json.dumps(obj, ensure_ascii=False)
+
+
+def _export_log(logger: Logger, log: LogBody) -> dict:
+    # same as LogExporter's json export, but for one log at a time
+    log_dict = log.model_dump(mode="json")
+    if isinstance(log, ActionLogBody):
+        if log.references is not None:
+            log_dict["references"] = (
+                [logger.message_pool.get_message_by_id(ref).model_dump(mode="json") for ref in log.references]
+                if log.references
+                else None
+            )
+        log_dict["response"] = logger.message_pool.get_message_by_id(log.response).model_dump(mode="json")
+    return log_dict
 
-    logs = {}
-    for exporter in self.scene.scene_definition.log_exporters:
-        data = exporter.export(self.logger, save_dir)
-        if data:
-            logs[f"{exporter.file_name}.{exporter.extension}"] = data
 
+async def _iter_task_results_json(self: SceneEngine, save_dir=None) -> AsyncIterator[str]:
+    """Serialize TaskResults piece by piece, logs are dumped one at a time instead of all in memory."""
     metrics, charts = self.reporter.generate_reports(
         scene_config=self.get_scene_config(mode="pydantic"),
         evaluator_configs=self.get_evaluator_configs(mode="pydantic"),
         logs=self.logger.logs,
     )
-    metrics = {
-        "metrics": {
-            name: (
-                [each.model_dump(mode="json") for each in data]
-                if isinstance(data, list)
-                else data.model_dump(mode="json")
-            )
-            for name, data in metrics["metrics"].items()
-        },
-        "human_metrics": {
-            name: (
+
+    yield f'{{"id": {_dumps(args.id)}'
+    yield f', "scene_config": {_dumps(self.get_scene_config(mode="dict"))}'
+    yield f', "evaluator_configs": {_dumps(self.get_evaluator_configs(mode="dict"))}'
+
+    yield ', "metrics": {'
+    for i, metrics_type in enumerate(["metrics", "human_metrics", "merged_metrics"]):
+        yield f'{", " if i else ""}{_dumps(metrics_type)}: {{'
+        for j, (name, data) in enumerate(metrics[metrics_type].items()):
+            data = (
                 [each.model_dump(mode="json") for each in data]
                 if isinstance(data, list)
                 else data.model_dump(mode="json")
             )
-            for name, data in metrics["human_metrics"].items()
-        },
-        "merged_metrics": {
-            name: (
-                [each.model_dump(mode="json") for each in data]
-                if isinstance(data, list)
-                else data.model_dump(mode="json")
+            yield f'{", " if j else ""}{_dumps(name)}: {_dumps(data)}'
+            await asyncio.sleep(0)
+        yield '}'
+    yield '}'
+
+    yield f', "charts": {_dumps(charts)}'
+
+    yield ', "logs": {'
+    num_sections = 0
+    for exporter in self.scene.scene_definition.log_exporters:
+        file_name = f"{exporter.file_name}.{exporter.extension}"
+        if exporter.extension == "csv":
+            data = exporter.export(self.logger, save_dir)
+            if not data:
+                continue
+            yield f'{", " if num_sections else ""}{_dumps(file_name)}: {_dumps(data)}'
+        else:
+            if save_dir:
+                exporter.export(self.logger, save_dir)
+            logs = self.logger.logs
+            if not logs:
+                continue
+            yield f'{", " if num_sections else ""}{_dumps(file_name)}: ['
+            for i, log in enumerate(logs):
+                yield f'{", " if i else ""}{_dumps(_export_log(self.logger, log))}'
+                if i % 100 == 99:
+                    await asyncio.sleep(0)
+            yield ']'
+        num_sections += 1
+    yield '}}'
+
+
+async def _encode_chunks(
+    chunks: AsyncIterator[str],
+    content_encoding: str,
+    chunk_size: int = 1 << 16
+) -> AsyncIterator[bytes]:
+    if content_encoding == "gzip":
+        compressor = zlib.compressobj(wbits=31)
+    elif content_encoding == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("zstandard not installed, please run `pip install zstandard` to enable zstd encoding.")
+        compressor = zstandard.ZstdCompressor().compressobj()
+    else:
+        compressor = None
+
+    buffer = []
+    buffer_size = 0
+    async for chunk in chunks:
+        data = chunk.encode("utf-8")
+        buffer.append(data)
+        buffer_size += len(data)
+        if buffer_size < chunk_size:
+            continue
+        data = b"".join(buffer)
+        buffer = []
+        buffer_size = 0
+        if compressor is not None:
+            data = compressor.compress(data)
+        if data:
+            yield data
+
+    data = b"".join(buffer)
+    if compressor is not None:
+        data = compressor.compress(data) + compressor.flush()
+    if data:
+        yield data
+
+
+async def save_task_results_to_db(self, save_dir=None):
+    # serialize uploads so that an older snapshot never overwrites a newer one
+    async with _task_results_lock:
+        try:
+            while True:
+                content_encoding = args.results_content_encoding
+                if content_encoding in _unsupported_content_encodings:
+                    content_encoding = "identity"
+                headers = {'Content-Type': 'application/json'}
+                if content_encoding != "identity":
+                    headers['Content-Encoding'] = content_encoding
+
+                # the body is streamed with chunked transfer encoding, a fresh stream is created for each attempt
+                status_code, text = await ServerClient().request(
+                    "post",
+                    f"/task/{args.id}/results/save?secret_key={args.secret_key}",
+                    headers=headers,
+                    data=lambda: _encode_chunks(_iter_task_results_json(self, save_dir), content_encoding)
+                )
+                # only 415 says the encoding is the problem, other 4xx are real errors and reported below
+                if content_encoding != "identity" and status_code == status.HTTP_415_UNSUPPORTED_MEDIA_TYPE:
+                    _unsupported_content_encodings.add(content_encoding)
+                    continue
+                break
+            if status_code != 200:
+                print(f"task [{args.id}] save results to database failed.")
+                print(text)
+        except:
+            traceback.print_exc()
+
+
+def schedule_save_task_results_to_db(self, save_dir=None) -> asyncio.Task:
+    # SceneEngine calls save synchronously, so the upload is scheduled on the running event loop
+    return asyncio.ensure_future(save_task_results_to_db(self, save_dir))
+
+
+SceneEngine.save = schedule_save_task_results_to_db
+
+
+DB_WRITE_SECONDS = Histogram(
+    "leaf_db_write_seconds",
+    "Latency of write requests DBLogHandler sends to the server.",
+    ["route"]
+)
+DB_WRITTEN_ITEMS = Counter(
+    "leaf_db_written_items",
+    "Number of messages and logs the server accepted.",
+    ["route"]
+)
+EVALUATOR_BACKLOG = Gauge(
+    "leaf_evaluator_backlog",
+    "Number of logs sent to the evaluator that don't have results yet.",
+    ["evaluator"]
+)
+EVALUATOR_SECONDS = Histogram(
+    "leaf_evaluator_seconds",
+    "Time from a log being sent to the evaluator to its results being reported.",
+    ["evaluator", "mode"],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, float("inf"))
+)
+
+
+def instrument_evaluator(evaluator: MetricEvaluator):
+    """Wrap the evaluator's record and compare, so scenes that await them directly are tracked too."""
+    evaluator_name = evaluator.__class__.__name__
+
+    def track(evaluate, mode: str):
+        @wraps(evaluate)
+        async def tracked_evaluate(log: ActionLogBody):
+            EVALUATOR_BACKLOG.labels(evaluator=evaluator_name).inc()
+            start = time.perf_counter()
+            try:
+                return await evaluate(log)
+            finally:
+                EVALUATOR_BACKLOG.labels(evaluator=evaluator_name).dec()
+                EVALUATOR_SECONDS.labels(evaluator=evaluator_name, mode=mode).observe(time.perf_counter() - start)
+
+        return tracked_evaluate
+
+    evaluator.record = track(evaluator.record, "record")
+    evaluator.compare = track(evaluator.compare, "compare")
+
+
+class LiveMetrics(Singleton):
+    """
+    Keep metrics up to date as the reporter receives records, for metrics whose aggregation function registered an
+    incremental aggregator (see `incremental_aggregator` in the project's aggregation module). Each record costs O(1),
+    instead of aggregating all records again every time metrics are read. Human records override evaluators' ones
+    of the same log in merged metrics, the same as the reporter does.
+    """
+
+    kinds = ["metrics", "human_metrics", "merged_metrics"]
+
+    def __init__(self, reporter: MetricReporter):
+        self.aggregator_factories = {}
+        for metric_name, metric_def in reporter.metric_definitions.items():
+            agg_method = getattr(metric_def, "agg_method", None)
+            if agg_method is None or isinstance(agg_method, str):
+                continue
+            agg_fn = dynamically_import_fn(agg_method)
+            factory = getattr(getattr(agg_fn, "func", agg_fn), "incremental_aggregator", None)
+            if factory is not None:
+                self.aggregator_factories[metric_name] = factory
+
+        # kind -> metric name -> agent id -> aggregator
+        self.aggregators = {kind: defaultdict(dict) for kind in self.kinds}
+        # (metric name, log id) -> [(agent id, value)], to take them out of merged metrics when a human overrides
+        self._evaluator_values: Dict[Tuple[str, str], List[Tuple[str, Any]]] = defaultdict(list)
+        self._human_values: Dict[Tuple[str, str], Tuple[str, Any]] = {}
+
+        self._wrap(reporter)
+
+    def _wrap(self, reporter: MetricReporter):
+        put_record = reporter.put_record
+        put_human_record = reporter.put_human_record
+
+        @wraps(put_record)
+        def tracked_put_record(record, metric_belonged_chain: str, log_id: str):
+            put_record(record, metric_belonged_chain, log_id)
+            if metric_belonged_chain in self.aggregator_factories:
+                self._add_record(metric_belonged_chain, log_id, record.target_agent, record.value)
+
+        @wraps(put_human_record)
+        def tracked_put_human_record(record, metric_belonged_chain: str, log_id: str):
+            put_human_record(record, metric_belonged_chain, log_id)
+            if metric_belonged_chain in self.aggregator_factories:
+                self._add_human_record(metric_belonged_chain, log_id, record.target_agent, record.value)
+
+        reporter.put_record = tracked_put_record
+        reporter.put_human_record = tracked_put_human_record
+
+    def _get_aggregator(self, kind: str, metric_name: str, agent_id: str):
+        agent2aggregator = self.aggregators[kind][metric_name]
+        if agent_id not in agent2aggregator:
+            agent2aggregator[agent_id] = self.aggregator_factories[metric_name]()
+        return agent2aggregator[agent_id]
+
+    def _add_record(self, metric_name: str, log_id: str, agent_id: str, value: Any):
+        key = (metric_name, log_id)
+        self._get_aggregator("metrics", metric_name, agent_id).add(value)
+        if key not in self._human_values:
+            self._get_aggregator("merged_metrics", metric_name, agent_id).add(value)
+        elif not self._evaluator_values[key]:
+            # merged metrics only cover logs evaluators recorded, so the human record counts from now on
+            self._get_aggregator("merged_metrics", metric_name, self._human_values[key][0]).add(
+                self._human_values[key][1]
             )
-            for name, data in metrics["merged_metrics"].items()
-        },
-    }
+        self._evaluator_values[key].append((agent_id, value))
+
+    def _add_human_record(self, metric_name: str, log_id: str, agent_id: str, value: Any):
+        key = (metric_name, log_id)
+        evaluator_values = self._evaluator_values.get(key)
+        if key in self._human_values:
+            old_agent_id, old_value = self._human_values[key]
+            self._get_aggregator("human_metrics", metric_name, old_agent_id).remove(old_value)
+            if evaluator_values:
+                self._get_aggregator("merged_metrics", metric_name, old_agent_id).remove(old_value)
+        elif evaluator_values:
+            for evaluator_agent_id, evaluator_value in evaluator_values:
+                self._get_aggregator("merged_metrics", metric_name, evaluator_agent_id).remove(evaluator_value)
+        self._human_values[key] = (agent_id, value)
+        self._get_aggregator("human_metrics", metric_name, agent_id).add(value)
+        if evaluator_values:
+            self._get_aggregator("merged_metrics", metric_name, agent_id).add(value)
+
+    def get_summary(self) -> dict:
+        return {
+            kind: {
+                metric_name: {
+                    agent_id: aggregator.get_summary() for agent_id, aggregator in agent2aggregator.items()
+                }
+                for metric_name, agent2aggregator in metric2aggregators.items()
+            }
+            for kind, metric2aggregators in self.aggregators.items()
+        }
 
-    task_results = TaskResults(
-        id=args.id,
-        scene_config=scene_config,
-        evaluator_configs=evaluator_configs,
-        metrics=metrics,
-        charts=charts,
-        logs=logs
-    )
 
-    try:
-        requests.post(
-            f"{args.server_url}/task/{args.id}/results/save?secret_key={args.secret_key}",
-            headers={'Content-Type': 'application/json'},
-            json=task_results.model_dump(mode="json", by_alias=True)
-        )
-    except:
-        traceback.print_exc()
+class ServerUnavailableError(Exception):
+    pass
+
+
+# how the server tells an insert failed because the item is in the database already
+DUPLICATE_ERROR_PATTERN = re.compile(r"duplicate key|already exists|unique constraint", flags=re.IGNORECASE)
 
 
-SceneEngine.save = save_task_results_to_db
+def is_duplicate_response(status_code: int, text: str) -> bool:
+    return status_code == status.HTTP_409_CONFLICT or (
+        status_code >= 500 and DUPLICATE_ERROR_PATTERN.search(text or "") is not None
+    )
+
+
+class LogSpool:
+    """
+    Append-only on-disk spool of database write batches.
+
+    Records are appended to segment files named by the sequence number of their first record, every append is
+    fsynced before it's acknowledged to the caller. A checkpoint file keeps how many records the server has
+    acknowledged, segments whose records are all acknowledged are deleted. Unacknowledged records left by a
+    previous process are replayed when the spool is opened again.
+    """
+
+    def __init__(self, spool_dir: str, segment_size: int):
+        self._spool_dir = spool_dir
+        self._segment_size = segment_size
+        # all file operations run on one thread, so the spool never blocks the event loop and needs no locks
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="log_spool")
+
+        self._checkpoint_path = os.path.join(spool_dir, "checkpoint")
+        self._acked_seq = 0
+        self._acked = set()
+        self._segments: List[int] = []
+        self._next_seq = 0
+        self._writer = None
+        self._read_seq = 0
+        self._reader = None
+        self._reader_segment = None
+
+        # the executor runs tasks in order, so appends, reads and acks submitted later run after the spool is open
+        self._opened = asyncio.get_running_loop().run_in_executor(self._executor, self._open)
+
+    def _open(self):
+        os.makedirs(self._spool_dir, exist_ok=True)
+        if os.path.exists(self._checkpoint_path):
+            with open(self._checkpoint_path, "r", encoding="utf-8") as f:
+                self._acked_seq = int(f.read().strip() or 0)
+
+        self._segments = sorted(
+            int(file_name[:-len(".jsonl")]) for file_name in os.listdir(self._spool_dir) if file_name.endswith(".jsonl")
+        )
+        self._next_seq = self._acked_seq
+        if self._segments:
+            last_segment_path = self._segment_path(self._segments[-1])
+            with open(last_segment_path, "rb") as f:
+                data = f.read()
+            # drop the partially written record a crash may have left at the end of the last segment
+            complete_size = data.rfind(b"\n") + 1
+            if complete_size != len(data):
+                with open(last_segment_path, "r+b") as f:
+                    f.truncate(complete_size)
+            self._next_seq = max(self._segments[-1] + data.count(b"\n"), self._acked_seq)
+            self._writer = open(last_segment_path, "ab")
+
+        self._read_seq = self._acked_seq
+        self._delete_acked_segments()
+
+    def _segment_path(self, first_seq: int) -> str:
+        return os.path.join(self._spool_dir, f"{first_seq:020d}.jsonl")
+
+    def _append(self, record: dict) -> int:
+        if self._writer is None or self._writer.tell() >= self._segment_size:
+            if self._writer is not None:
+                self._writer.close()
+            self._writer = open(self._segment_path(self._next_seq), "ab")
+            self._segments.append(self._next_seq)
+        self._writer.write((_dumps(record) + "\n").encode("utf-8"))
+        self._writer.flush()
+        os.fsync(self._writer.fileno())
+        seq = self._next_seq
+        self._next_seq += 1
+        return seq
+
+    def _read(self) -> Tuple[int, dict]:
+        segment = self._segments[bisect.bisect_right(self._segments, self._read_seq) - 1]
+        if self._reader is None or self._reader_segment != segment:
+            if self._reader is not None:
+                self._reader.close()
+            self._reader = open(self._segment_path(segment), "rb")
+            self._reader_segment = segment
+            for _ in range(self._read_seq - segment):
+                self._reader.readline()
+        seq = self._read_seq
+        record = json.loads(self._reader.readline())
+        self._read_seq += 1
+        return seq, record
+
+    def _ack(self, seq: int):
+        self._acked.add(seq)
+        if self._acked_seq not in self._acked:
+            return
+        while self._acked_seq in self._acked:
+            self._acked.remove(self._acked_seq)
+            self._acked_seq += 1
+        tmp_path = self._checkpoint_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(str(self._acked_seq))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._checkpoint_path)
+        self._delete_acked_segments()
+
+    def _delete_acked_segments(self):
+        # the last segment is still written to, it's never deleted
+        while len(self._segments) > 1 and self._segments[1] <= self._acked_seq:
+            segment = self._segments.pop(0)
+            if self._reader_segment == segment:
+                self._reader.close()
+                self._reader = None
+                self._reader_segment = None
+            try:
+                os.remove(self._segment_path(segment))
+            except OSError:
+                traceback.print_exc()
+
+    async def wait_opened(self):
+        await asyncio.shield(self._opened)
+
+    async def append(self, record: dict) -> int:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._append, record)
+
+    async def read(self) -> Tuple[int, dict]:
+        """Read the next record, only call it when there are unread records."""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._read)
+
+    async def ack(self, seq: int):
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._ack, seq)
+
+    @property
+    def num_unread(self) -> int:
+        return self._next_seq - self._read_seq
+
+    @property
+    def num_unacked(self) -> int:
+        return self._next_seq - self._acked_seq
+
+    @property
+    def num_segments(self) -> int:
+        return len(self._segments)
 
 
 class DBLogHandler(Singleton, LogHandler):
@@ -123,61 +562,385 @@ class DBLogHandler(Singleton, LogHandler):
         super().__init__()
 
         self._message_pool = MessagePool()
-        self._submitted_messages = set()
-        self._http_session = aiohttp.ClientSession(base_url=args.server_url)
-
-        self._queue = asyncio.Queue()
+        # most recently submitted message ids, bounded so that long-running tasks don't grow it forever,
+        # a message is almost always referenced again shortly after it's created, if ever
+        self._submitted_messages: "OrderedDict[str, None]" = OrderedDict()
+        # bytes of the ids above, kept up to date so that reporting it doesn't walk the whole window
+        self._submitted_messages_bytes = 0
+        self._client = ServerClient()
+
+        # Logger calls notify_* in tasks nobody awaits, so a full queue can't slow the scene down, puts that don't
+        # fit wait as pending tasks until the write loop catches up
+        self._queue = asyncio.Queue(maxsize=args.db_write_queue_size)
+        # logs notified (or updates flushed) but not spooled yet, whether queued, waiting to be queued or in the batch
+        # being assembled
+        self._num_unspooled = 0
+        # every batch is persisted here first, then replayed to the server
+        self._spool = LogSpool(
+            args.db_spool_dir or os.path.join(os.path.dirname(os.path.abspath(__file__)), "spool", args.id),
+            args.db_spool_segment_size
+        )
+        self._spool_appended = asyncio.Event()
+        # limits how many batches can be in flight at the same time
+        self._batch_semaphore = asyncio.Semaphore(args.db_write_concurrency)
+        # resolved once the latest batch that writes the log finished, the next batch writing the same log waits on
+        # it, so that writes of each log reach the server in the order they were spooled
+        self._log_write_lanes: Dict[str, asyncio.Future] = {}
+        # resolved once the latest batch and every batch before it inserted their messages, logs reference messages
+        # of earlier batches (each message is only inserted once), so log inserts wait on it
+        self._messages_inserted: Optional[asyncio.Future] = None
+        # bulk routes the server responded 404/405 to, single-item routes are used for them instead
+        self._unsupported_bulk_routes = set()
+        # updates waiting for the coalescing window to close, only the latest state of each log is sent
+        self._pending_updates: Dict[str, LogBody] = {}
+
+        self._num_updates_received = 0
+        self._num_updates_coalesced = 0
+        self._num_updates_written = 0
+        self._num_write_retries = 0
 
         asyncio.ensure_future(self.db_write_loop())
+        asyncio.ensure_future(self.db_replay_loop())
+
+    async def _next_batch(self) -> List[Tuple[LogBody, bool]]:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + args.db_write_batch_interval
+        while len(batch) < args.db_write_batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout=timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
 
     async def db_write_loop(self):
         while True:
-            log_body: LogBody = await self._queue.get()
-            is_update = log_body.created_at != log_body.last_update
-            if not is_update:
-                if isinstance(log_body, ActionLogBody):
-                    message = self._message_pool.get_message_by_id(log_body.response)
-                    if message.id not in self._submitted_messages:
-                        self._submitted_messages.add(message.id)
-                        async with self._http_session.post(
-                            f"/task/{args.id}/messages/insert?secret_key={args.secret_key}",
-                            headers={'Content-Type': 'application/json'},
-                            json=Message.init_from_message(message, args.id).model_dump(mode="json", by_alias=True)
-                        ) as resp:
-                            if resp.status != 200:
-                                print(f"task [{args.id}] insert message [{message.id}] to database failed.")
-                                print(await resp.text())
-                async with self._http_session.post(
-                    f"/task/{args.id}/logs/insert?secret_key={args.secret_key}",
-                    headers={'Content-Type': 'application/json'},
-                    json=Log.init_from_log_body(log_body, args.id).model_dump(mode="json", by_alias=True)
-                ) as resp:
-                    if resp.status != 200:
-                        print(f"task [{args.id}] insert log [{log_body.id}] to database failed.")
-                        print(await resp.text())
-            else:
-                async with self._http_session.patch(
-                    f"/task/{args.id}/logs/update?secret_key={args.secret_key}",
-                    headers={'Content-Type': 'application/json'},
-                    json=Log.init_from_log_body(log_body, args.id).model_dump(mode="json", by_alias=True)
-                ) as resp:
-                    if resp.status != 200:
-                        print(f"task [{args.id}] update log [{log_body.id}] to database failed.")
-                        print(await resp.text())
+            batch = await self._next_batch()
+
+            messages = {}
+            log_inserts = {}
+            log_updates = {}
+            for log_body, is_update in batch:
+                if not is_update:
+                    if isinstance(log_body, ActionLogBody):
+                        message = self._message_pool.get_message_by_id(log_body.response)
+                        if self._mark_message_submitted(message.id):
+                            messages[message.id] = Message.init_from_message(message, args.id).model_dump(
+                                mode="json", by_alias=True
+                            )
+                    log_inserts[log_body.id] = Log.init_from_log_body(log_body, args.id).model_dump(
+                        mode="json", by_alias=True
+                    )
+                else:
+                    if log_body.id in log_updates:
+                        self._num_updates_coalesced += 1
+                    log_updates[log_body.id] = Log.init_from_log_body(log_body, args.id).model_dump(
+                        mode="json", by_alias=True
+                    )
+
+            try:
+                await self._spool.append(
+                    {"messages": messages, "log_inserts": log_inserts, "log_updates": log_updates}
+                )
+            except:
+                traceback.print_exc()
+                print(
+                    f"task [{args.id}] spool {len(log_inserts)} log inserts and {len(log_updates)} log updates failed."
+                )
+                continue
+            finally:
+                self._num_unspooled -= len(batch)
+            self._spool_appended.set()
+
+    def _mark_message_submitted(self, message_id: str) -> bool:
+        """Return False if the message was submitted recently, otherwise remember it and return True."""
+        if message_id in self._submitted_messages:
+            self._submitted_messages.move_to_end(message_id)
+            return False
+        self._submitted_messages[message_id] = None
+        self._submitted_messages_bytes += sys.getsizeof(message_id)
+        if len(self._submitted_messages) > args.db_message_dedup_window:
+            evicted_id, _ = self._submitted_messages.popitem(last=False)
+            self._submitted_messages_bytes -= sys.getsizeof(evicted_id)
+        return True
+
+    async def db_replay_loop(self):
+        loop = asyncio.get_running_loop()
+        try:
+            await self._spool.wait_opened()
+        except:
+            traceback.print_exc()
+            print(f"task [{args.id}] open spool failed, logs won't be written to database.")
+            return
+        while True:
+            if not self._spool.num_unread:
+                self._spool_appended.clear()
+                await self._spool_appended.wait()
+                continue
+            try:
+                seq, record = await self._spool.read()
+            except:
+                traceback.print_exc()
+                await asyncio.sleep(1)
+                continue
+
+            # batches are dispatched in spool order and only wait on earlier ones, so they can't wait on each other
+            log_ids = set(record["log_inserts"]) | set(record["log_updates"])
+            wait_for_previous = [self._log_write_lanes[log_id] for log_id in log_ids if log_id in self._log_write_lanes]
+            done = loop.create_future()
+            for log_id in log_ids:
+                self._log_write_lanes[log_id] = done
+            previous_messages_inserted = self._messages_inserted
+            messages_inserted = self._messages_inserted = loop.create_future()
+
+            await self._batch_semaphore.acquire()
+            write_task = asyncio.ensure_future(
+                self._write_batch(
+                    seq,
+                    record,
+                    list(set(wait_for_previous)),
+                    done,
+                    previous_messages_inserted,
+                    messages_inserted
+                )
+            )
+            write_task.add_done_callback(lambda _: self._batch_semaphore.release())
+
+    async def _write_batch(
+        self,
+        seq: int,
+        record: dict,
+        wait_for_previous: List[asyncio.Future],
+        done: asyncio.Future,
+        previous_messages_inserted: Optional[asyncio.Future],
+        messages_inserted: asyncio.Future
+    ):
+        log_ids = set(record["log_inserts"]) | set(record["log_updates"])
+        try:
+            try:
+                if record["messages"]:
+                    await self._write_with_retry("post", "/messages/insert", record["messages"], "insert message")
+                # the server resolves a log's messages when the log is inserted
+                if previous_messages_inserted is not None:
+                    await previous_messages_inserted
+            finally:
+                messages_inserted.set_result(None)
+            if record["log_inserts"]:
+                await self._write_with_retry("post", "/logs/insert", record["log_inserts"], "insert log")
+            if record["log_updates"]:
+                # earlier inserts and updates of the same logs must reach the server first
+                await asyncio.gather(*wait_for_previous)
+                self._num_updates_written += len(record["log_updates"])
+                await self._write_with_retry("patch", "/logs/update", record["log_updates"], "update log")
+        finally:
+            done.set_result(None)
+            for log_id in log_ids:
+                if self._log_write_lanes.get(log_id) is done:
+                    self._log_write_lanes.pop(log_id)
+
+        try:
+            await self._spool.ack(seq)
+        except:
+            traceback.print_exc()
+
+    async def _write_with_retry(self, method: str, route: str, items: Dict[str, dict], action: str):
+        """
+        Write items until the server accepted them. The server being unreachable, timeouts and 5xx responses are
+        retried with backoff until the server is back, the batch stays in the spool meanwhile. Other errors won't be
+        fixed by retrying.
+        """
+        attempt = 0
+        while True:
+            try:
+                await self._write_items(method, route, items, action)
+                return
+            except (aiohttp.ClientError, asyncio.TimeoutError, ServerUnavailableError) as e:
+                delay = min(2 ** attempt, args.db_spool_max_backoff) * random.uniform(0.5, 1.0)
+                print(f"task [{args.id}] {action}s to database failed ({e!r}), will retry in {delay:.1f}s.")
+                self._num_write_retries += 1
+                attempt += 1
+                await asyncio.sleep(delay)
+            except:
+                traceback.print_exc()
+                return
+
+    async def _write_items(self, method: str, route: str, items: Dict[str, dict], action: str):
+        """
+        Write items to the server, written items are removed from `items` so that a retry only sends the rest.
+
+        Inserts aren't idempotent, a retried insert the server committed before fails as a duplicate. A bulk insert
+        failing so is written again item by item, items the server reports as duplicates are in the database already.
+        """
+        if len(items) > 1 and route not in self._unsupported_bulk_routes:
+            start = time.perf_counter()
+            status_code, text = await self._client.request(
+                method,
+                f"/task/{args.id}{route}/bulk?secret_key={args.secret_key}",
+                headers={'Content-Type': 'application/json'},
+                json=list(items.values())
+            )
+            DB_WRITE_SECONDS.labels(route=f"{route}/bulk").observe(time.perf_counter() - start)
+            if status_code == 200:
+                DB_WRITTEN_ITEMS.labels(route=route).inc(len(items))
+            if status_code in [status.HTTP_404_NOT_FOUND, status.HTTP_405_METHOD_NOT_ALLOWED]:
+                self._unsupported_bulk_routes.add(route)
+            elif not is_duplicate_response(status_code, text):
+                if status_code >= 500:
+                    raise ServerUnavailableError(f"status code {status_code}")
+                if status_code != 200:
+                    print(f"task [{args.id}] {action}s [{', '.join(items)}] to database failed.")
+                    print(text)
+                items.clear()
+                return
+            # otherwise some of them are in the database already, the items written one by one below tell which
+
+        async def write_item(item_id: str, item: dict) -> int:
+            start = time.perf_counter()
+            status_code, text = await self._client.request(
+                method,
+                f"/task/{args.id}{route}?secret_key={args.secret_key}",
+                headers={'Content-Type': 'application/json'},
+                json=item
+            )
+            DB_WRITE_SECONDS.labels(route=route).observe(time.perf_counter() - start)
+            if status_code == 200:
+                DB_WRITTEN_ITEMS.labels(route=route).inc()
+            if is_duplicate_response(status_code, text):
+                items.pop(item_id)
+                print(f"task [{args.id}] {action} [{item_id}] is in database already.")
+            elif status_code < 500:
+                items.pop(item_id)
+                if status_code != 200:
+                    print(f"task [{args.id}] {action} [{item_id}] to database failed.")
+                    print(text)
+            return status_code
+
+        results = await asyncio.gather(
+            *[write_item(item_id, item) for item_id, item in list(items.items())], return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        if items:
+            raise ServerUnavailableError(f"status codes {sorted(set(results))}")
 
     async def notify_create(self, log_body: LogBody):
-        self._queue.put_nowait(log_body)
+        # whether it is an update is decided here, the log may be updated again before it's written
+        self._num_unspooled += 1
+        await self._queue.put((log_body, False))
 
     async def notify_update(self, log_body: LogBody):
         log_body.last_update = datetime.utcnow()
-        self._queue.put_nowait(log_body)
+        self._num_updates_received += 1
+        if log_body.id in self._pending_updates:
+            self._num_updates_coalesced += 1
+        else:
+            asyncio.get_running_loop().call_later(
+                args.db_update_coalesce_window, self._flush_pending_update, log_body.id
+            )
+        self._pending_updates[log_body.id] = log_body
+
+    def _flush_pending_update(self, log_id: str):
+        self._num_unspooled += 1
+        asyncio.ensure_future(self._queue.put((self._pending_updates.pop(log_id), True)))
+
+    async def wait_until_written(self, timeout: float):
+        """Wait until everything notified so far is acknowledged by the server, at most `timeout` seconds."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        try:
+            await asyncio.wait_for(self._spool.wait_opened(), timeout)
+        except:
+            return
+        while self._num_unspooled or self._pending_updates or self._spool.num_unacked:
+            if loop.time() >= deadline:
+                print(f"task [{args.id}] {self._spool.num_unacked} batches not written to database yet.")
+                return
+            await asyncio.sleep(0.1)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queue_size": self._queue.qsize(),
+            "unspooled_logs": self._num_unspooled,
+            "pending_updates": len(self._pending_updates),
+            "updates_received": self._num_updates_received,
+            "updates_coalesced": self._num_updates_coalesced,
+            "updates_written": self._num_updates_written,
+            "spool_unacked_batches": self._spool.num_unacked,
+            "spool_segments": self._spool.num_segments,
+            "write_retries": self._num_write_retries,
+            "tracked_message_ids": len(self._submitted_messages),
+            "tracking_memory_bytes": self._tracking_memory_bytes(),
+        }
+
+    def _tracking_memory_bytes(self) -> int:
+        """Approximate memory used by the handler's in-memory bookkeeping, excluding the spool on disk."""
+        return (
+            sys.getsizeof(self._submitted_messages)
+            + self._submitted_messages_bytes
+            + sys.getsizeof(self._pending_updates)
+            + sys.getsizeof(self._log_write_lanes)
+        )
+
 
+class DBLogHandlerCollector:
+    """Expose DBLogHandler's stats to prometheus, they are read at scrape time."""
 
-def create_engine():
+    counters = ["updates_received", "updates_coalesced", "updates_written", "write_retries"]
+
+    def collect(self):
+        try:
+            stats = DBLogHandler.get_instance().stats
+        except KeyError:
+            return
+        for name, value in stats.items():
+            metric_family_cls = CounterMetricFamily if name in self.counters else GaugeMetricFamily
+            yield metric_family_cls(f"leaf_db_{name}", f"DBLogHandler {name.replace('_', ' ')}.", value=value)
+
+
+REGISTRY.register(DBLogHandlerCollector())
+
+
+class LiveMetricsCollector:
+    """Expose live metrics to prometheus, they are read at scrape time."""
+
+    def collect(self):
+        try:
+            live_metrics = LiveMetrics.get_instance()
+        except KeyError:
+            return
+        value_family = GaugeMetricFamily(
+            "leaf_live_metric_value", "Metric value aggregated so far.", labels=["kind", "metric", "agent"]
+        )
+        count_family = GaugeMetricFamily(
+            "leaf_live_metric_records", "Records a metric value is aggregated from.", labels=["kind", "metric", "agent"]
+        )
+        for kind, metric2summaries in live_metrics.get_summary().items():
+            for metric_name, agent2summary in metric2summaries.items():
+                for agent_id, summary in agent2summary.items():
+                    if isinstance(summary.get("value"), (int, float)):
+                        value_family.add_metric([kind, metric_name, agent_id], summary["value"])
+                    if "count" in summary:
+                        count_family.add_metric([kind, metric_name, agent_id], summary["count"])
+        yield value_family
+        yield count_family
+
+
+REGISTRY.register(LiveMetricsCollector())
+
+
+async def create_engine():
     DBLogHandler()
     try:
-        resp = requests.get(f"{args.server_url}/task/{args.id}/payload")
-        payload = TaskCreationPayload(**resp.json())
+        _, text = await ServerClient.get_instance().request("get", f"/task/{args.id}/payload")
+        payload = TaskCreationPayload(**json.loads(text))
 
         scene_engine = SceneEngine(
             scene_config=payload.scene_obj_config,
@@ -187,19 +950,25 @@ def create_engine():
             state_change_callbacks=[scene_engine_state_change_callback],
             log_handlers=[DBLogHandler.get_instance()]
         )
+        for evaluator in scene_engine.evaluators:
+            instrument_evaluator(evaluator)
+        LiveMetrics(scene_engine.reporter)
         asyncio.create_task(scene_engine.run())
     except:
         traceback.print_exc()
-        update_task_status(SceneEngineState.FAILED.value)
+        await update_task_status(SceneEngineState.FAILED.value)
 
 
-def update_task_status(task_status: str):
-    try:
-        requests.patch(
-            f"{args.server_url}/task/{args.id}/status?task_status={task_status}&secret_key={args.secret_key}",
-        )
-    except:
-        pass
+async def update_task_status(task_status: str):
+    # the lock is fair, so status changes reach the server in the order they happened
+    async with _task_status_lock:
+        try:
+            await ServerClient().request(
+                "patch",
+                f"/task/{args.id}/status?task_status={task_status}&secret_key={args.secret_key}",
+            )
+        except:
+            pass
 
 
 def scene_engine_state_change_callback():
@@ -208,7 +977,7 @@ def scene_engine_state_change_callback():
     except:
         scene_engine = None
     task_status = scene_engine.state.value if scene_engine is not None else SceneEngineState.PENDING.value
-    update_task_status(task_status)
+    asyncio.ensure_future(update_task_status(task_status))
 
 
 class AppManager(Singleton):
@@ -218,6 +987,7 @@ class AppManager(Singleton):
 
     async def maybe_shutdown(self):
         await self.shutdown_event.wait()
+        await DBLogHandler.get_instance().wait_until_written(timeout=args.db_spool_drain_timeout)
         await asyncio.sleep(3)
         os.kill(os.getpid(), signal.SIGTERM)
 
@@ -230,11 +1000,11 @@ async def lifespan(application: FastAPI):
             patch_multiprocessing=False
         )
 
-        create_engine()
+        await create_engine()
         app_manager = AppManager()
     except:
         traceback.print_exc()
-        update_task_status(task_status="failed")
+        await update_task_status(task_status="failed")
     else:
         try:
             yield
@@ -261,6 +1031,21 @@ async def agents_connected(scene_engine: SceneEngine = Depends(SceneEngine.get_i
     )
 
 
+@app.get("/db_write_stats")
+async def db_write_stats(log_handler: DBLogHandler = Depends(DBLogHandler.get_instance)) -> JSONResponse:
+    return JSONResponse(content=log_handler.stats)
+
+
+@app.get("/metrics")
+async def metrics() -> Response:
+    return Response(content=generate_latest(REGISTRY), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get("/metrics/live")
+async def live_metrics(live_metrics_: LiveMetrics = Depends(LiveMetrics.get_instance)) -> JSONResponse:
+    return JSONResponse(content=live_metrics_.get_summary())
+
+
 @app.websocket("/ws/human/{agent_id}")
 async def human_input(
     websocket: WebSocket,
@@ -309,7 +1094,7 @@ async def close_engine(
 ):
     if scene_engine.state not in [SceneEngineState.INTERRUPTED, SceneEngineState.FAILED, SceneEngineState.FINISHED]:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="task not done!")
-    save_task_results_to_db(scene_engine)
+    await save_task_results_to_db(scene_engine)
     app_manager.shutdown_event.set()
 
 
@@ -317,7 +1102,7 @@ async def close_engine(
 async def save_engine(
     scene_engine: SceneEngine = Depends(SceneEngine.get_instance)
 ):
-    save_task_results_to_db(scene_engine)
+    await save_task_results_to_db(scene_engine)
 
 
 @app.post("/logs/{log_id}/record/metric/update")
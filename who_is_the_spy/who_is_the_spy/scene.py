@@ -13,6 +13,7 @@ from leaf_playground.data.media import Text
 from .agents.moderator import Moderator
 from .agents.player import BaseAIPlayer
 from .agents.human_player import HumanPlayer
+from .instrumentation import SAMPLES_FINISHED, track_agent_action
 from .scene_definition import *
 
 
@@ -65,7 +66,8 @@ class WhoIsTheSpyScene(Scene, scene_definition=SCENE_DEFINITION, log_body_class=
             history = self.message_pool.get_messages(player.profile)
             key_assignment_msg: ModeratorKeyAssignment = history[-1]
             try:
-                await player.receive_key(key_assignment_msg)
+                with track_agent_action(player.name, "receive_key"):
+                    await player.receive_key(key_assignment_msg)
             except:
                 if self.config.debug_mode:
                     raise
@@ -73,9 +75,10 @@ class WhoIsTheSpyScene(Scene, scene_definition=SCENE_DEFINITION, log_body_class=
         async def player_describe_key(player_: Player) -> PlayerDescription:
             history = self.message_pool.get_messages(player_.profile)
             try:
-                description = await player_.describe_key(
-                    history, [self.moderator.profile]
-                )
+                with track_agent_action(player_.name, "describe_key"):
+                    description = await player_.describe_key(
+                        history, [self.moderator.profile]
+                    )
             except:
                 if self.config.debug_mode:
                     raise
@@ -134,7 +137,8 @@ class WhoIsTheSpyScene(Scene, scene_definition=SCENE_DEFINITION, log_body_class=
         async def player_predict_role(player_: Player) -> PlayerPrediction:
             history = self.message_pool.get_messages(player_.profile)
             try:
-                prediction = await player_.predict_role(history, self.moderator.profile)
+                with track_agent_action(player_.name, "predict_role"):
+                    prediction = await player_.predict_role(history, self.moderator.profile)
             except:
                 if self.config.debug_mode:
                     raise
@@ -153,7 +157,8 @@ class WhoIsTheSpyScene(Scene, scene_definition=SCENE_DEFINITION, log_body_class=
         async def player_vote(player_: Player) -> PlayerVote:
             history = self.message_pool.get_messages(player_.profile)
             try:
-                vote = await player_.vote(history, self.moderator.profile)
+                with track_agent_action(player_.name, "vote"):
+                    vote = await player_.vote(history, self.moderator.profile)
             except:
                 if self.config.debug_mode:
                     raise
@@ -289,6 +294,7 @@ class WhoIsTheSpyScene(Scene, scene_definition=SCENE_DEFINITION, log_body_class=
                     player for player in players if self.moderator.id2status[player.id] == PlayerStatus.ALIVE
                 ]
 
+            SAMPLES_FINISHED.labels(scene=self.__class__.__name__).inc()
             num_games -= 1
             game_id += 1
 
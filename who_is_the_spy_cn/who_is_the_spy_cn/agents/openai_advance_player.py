@@ -8,6 +8,8 @@ from leaf_playground.utils.import_util import DynamicObject
 from pydantic import Field
 
 from .player import BaseAIPlayer, BaseAIPlayerConfig
+from ..rate_limiter import RateLimitConfig
+from ..response_cache import ResponseCacheConfig, create_chat_completion
 from ..scene_definition import *
 
 
@@ -42,6 +44,8 @@ class CustomOpenAIBackendConfig(OpenAIBackendConfig):
 class OpenAIAdvancePlayerConfig(BaseAIPlayerConfig):
     ai_backend_config: CustomOpenAIBackendConfig = Field(default=...)
     ai_backend_cls: Type[OpenAIBackend] = Field(default=OpenAIBackend, exclude=True)
+    response_cache_config: ResponseCacheConfig = Field(default_factory=ResponseCacheConfig)
+    rate_limit_config: RateLimitConfig = Field(default_factory=RateLimitConfig)
 
 
 class OpenAIAdvancePlayer(
@@ -107,13 +111,15 @@ class OpenAIAdvancePlayer(
         return messages
 
     async def _respond(self, history: List[MessageTypes], mode: Literal['description', 'prediction', 'vote']) -> str:
-        resp = await self.client.chat.completions.create(
+        response = await create_chat_completion(
+            self.client,
+            self.config.response_cache_config,
+            rate_limit_config=self.config.rate_limit_config,
             messages=self._prepare_chat_message(history, mode),
             model=self.config.ai_backend_config.chat_model,
             max_tokens=256,
             temperature=0.9
         )
-        response = resp.choices[0].message.content
         return response
 
     async def receive_key(self, key_assignment: ModeratorKeyAssignment) -> None:
@@ -7,6 +7,8 @@ from leaf_playground.data.profile import Profile
 from pydantic import Field
 
 from .player import BaseAIPlayer, BaseAIPlayerConfig
+from ..rate_limiter import RateLimitConfig
+from ..response_cache import ResponseCacheConfig, create_chat_completion
 from ..scene_definition import *
 
 
@@ -41,6 +43,8 @@ class CustomOpenAIBackendConfig(OpenAIBackendConfig):
 class OpenAIBasicPlayerConfig(BaseAIPlayerConfig):
     ai_backend_config: CustomOpenAIBackendConfig = Field(default=...)
     ai_backend_cls: Type[OpenAIBackend] = Field(default=OpenAIBackend, exclude=True)
+    response_cache_config: ResponseCacheConfig = Field(default_factory=ResponseCacheConfig)
+    rate_limit_config: RateLimitConfig = Field(default_factory=RateLimitConfig)
 
 
 class OpenAIBasicPlayer(
@@ -84,13 +88,15 @@ class OpenAIBasicPlayer(
         return messages
 
     async def _respond(self, history: List[MessageTypes]) -> str:
-        resp = await self.client.chat.completions.create(
+        response = await create_chat_completion(
+            self.client,
+            self.config.response_cache_config,
+            rate_limit_config=self.config.rate_limit_config,
             messages=self._prepare_chat_message(history),
             model=self.config.ai_backend_config.chat_model,
             max_tokens=256,
             temperature=0.9
         )
-        response = resp.choices[0].message.content
         return response
 
     async def receive_key(self, key_assignment: ModeratorKeyAssignment) -> None: